@@ -0,0 +1,90 @@
+#! /usr/bin/env python
+
+# SPDX-FileCopyrightText: 2023 Fredrik Salomonsson <plattfot@posteo.net>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Compare the copy throughput with and without reordering the copies.
+
+Copies the images and videos in SRC, e.g. a mounted card, to DEST the
+way picmover lays them out (date and type of file from the mtime and
+extension), once in the order they are found and once reordered by
+destination directory and position on the disk. The source is dropped
+from the page cache before each round so it's read from the disk.
+
+Usage: copy_order.py [-r ROUNDS] [-j JOBS] SRC DEST
+"""
+
+import argparse
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import picmover  # noqa: E402
+
+SUBDIRS = {'RAW': 'raw', 'JPG': 'JPEG', 'MOV': 'mov'}
+
+
+def drop_cache(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def time_copy(files, dest, jobs, reorder, rounds):
+    best = None
+    for _ in range(rounds):
+        for entry in files:
+            drop_cache(entry.path)
+        target = tempfile.mkdtemp(dir=dest)
+        engine = picmover.CopyEngine(jobs, reorder=len(files) if reorder
+                                     else 0)
+        start = time.perf_counter()
+        for entry in files:
+            date = datetime.date.fromtimestamp(entry.stat.st_mtime)
+            engine.submit(entry.path, os.path.join(
+                target, str(date), SUBDIRS[entry.filetype], entry.name))
+        engine.finish()
+        os.sync()
+        elapsed = time.perf_counter() - start
+        shutil.rmtree(target)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("src", help="Directory with images and videos.")
+    parser.add_argument("dest", help="Directory to copy the files to.")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="Number of files to copy at the same time.")
+    parser.add_argument("-r", "--rounds", type=int, default=3,
+                        help="Number of rounds, the best is reported.")
+    args = parser.parse_args()
+
+    files = [entry for group in picmover.scan_pool(args.src)
+             for entry in group]
+    if not files:
+        sys.exit("No images or videos found.")
+    total = sum(entry.stat.st_size for entry in files)
+
+    found = time_copy(files, args.dest, args.jobs, False, args.rounds)
+    reordered = time_copy(files, args.dest, args.jobs, True, args.rounds)
+
+    print(f"{len(files)} files, {picmover.format_size(total)}, "
+          f"best of {args.rounds} rounds")
+    print(f"found order: {found:.3f} s "
+          f"({picmover.format_size(total / found)}/s)")
+    print(f"reordered:   {reordered:.3f} s "
+          f"({picmover.format_size(total / reordered)}/s)")
+    print(f"speedup: {found / reordered:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#! /usr/bin/env python
+
+# SPDX-FileCopyrightText: 2023 Fredrik Salomonsson <plattfot@posteo.net>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Compare the time it takes to read the metadata from the images and
+videos in a directory using gexiv2 and picmover's own header readers.
+
+Usage: exif_readers.py [-r ROUNDS] DIR
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import picmover  # noqa: E402
+
+EXTENSIONS = ('.jpg', '.jpeg', '.nef', '.nrw', '.cr2', '.arw', '.sr2',
+              '.dng', '.orf', '.rw2', '.pef', '.srw', '.3fr', '.erf',
+              '.raf', '.crw', '.mrw', '.x3f')
+MOV_EXTENSIONS = ('.mov', '.mp4')
+
+
+def time_reader(paths, fast, rounds):
+    exif_img = picmover.ExifImg('Unknown maker', 'Unknown model')
+    exif_mov = picmover.ExifMov('Unknown maker', 'Unknown model')
+    best = None
+    records = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        records = [picmover.read_metadata(
+            p, exif_mov if p.lower().endswith(MOV_EXTENSIONS) else exif_img,
+            fast) for p in paths]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("corpus", help="Directory with images and videos.")
+    parser.add_argument("-r", "--rounds", type=int, default=3,
+                        help="Number of rounds, the best is reported.")
+    args = parser.parse_args()
+
+    paths = []
+    for root, _, files in os.walk(args.corpus):
+        for f in files:
+            if f.lower().endswith(EXTENSIONS + MOV_EXTENSIONS):
+                paths.append(os.path.join(root, f))
+    if not paths:
+        sys.exit("No images or videos found.")
+
+    slow, expected = time_reader(paths, False, args.rounds)
+    fast, actual = time_reader(paths, True, args.rounds)
+
+    mismatches = 0
+    for path, a, b in zip(paths, expected, actual):
+        if a.make != b.make or a.model != b.model or a.date != b.date or \
+           [round(float(x), 5) for x in a.gps] != \
+           [round(float(x), 5) for x in b.gps]:
+            mismatches += 1
+            print(f"Mismatch {path}:\n  gexiv2: {a}\n  fast:   {b}")
+
+    n = len(paths)
+    print(f"{n} files, best of {args.rounds} rounds")
+    print(f"gexiv2: {slow:.3f} s ({slow / n * 1e6:.0f} us/file)")
+    print(f"fast:   {fast:.3f} s ({fast / n * 1e6:.0f} us/file)")
+    print(f"speedup: {slow / fast:.1f}x, mismatches: {mismatches}")
+
+
+if __name__ == "__main__":
+    main()
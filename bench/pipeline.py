@@ -0,0 +1,346 @@
+#! /usr/bin/env python
+
+# SPDX-FileCopyrightText: 2023 Fredrik Salomonsson <plattfot@posteo.net>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Time a full import of a synthetic pool, end to end and per stage.
+
+Generates a pool of JPEGs and TIFF based raws with EXIF and MP4s with
+QuickTime metadata for a mix of cameras, dates and locations, and a
+destination with existing events. Then imports it with PicMover.exe
+as a dry run and as a copy, with a local stub of Nominatim for --gps,
+and writes the results as JSON. Pass the results of an earlier run
+with --compare to see what changed.
+
+Usage: pipeline.py [-n SHOTS] [--gps] [-o RESULTS] [--compare OLD]
+"""
+
+import argparse
+import contextlib
+import datetime
+import http.server
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import picmover  # noqa: E402
+
+CAMERAS = "NIKON CORPORATION/NIKON D750,Canon/Canon EOS R5,Apple/iPhone 12"
+RAW_EXTENSIONS = {'NIKON CORPORATION': '.NEF', 'Canon': '.CR2'}
+
+
+def tiff_ifd(entries, endian, start):
+    """IFD at offset START with ENTRIES (tag, type, count, bytes)."""
+    out = struct.pack(endian + 'H', len(entries))
+    data = start + 2 + 12 * len(entries) + 4
+    blobs = b''
+    for tag, kind, count, value in sorted(entries):
+        out += struct.pack(endian + 'HHI', tag, kind, count)
+        if len(value) <= 4:
+            out += value.ljust(4, b'\0')
+        else:
+            out += struct.pack(endian + 'I', data + len(blobs))
+            blobs += value + b'\0' * (len(value) % 2)
+    return out + struct.pack(endian + 'I', 0) + blobs
+
+
+def ascii_tag(tag, text):
+    value = text.encode() + b'\0'
+    return (tag, 2, len(value), value)
+
+
+def rational_tag(tag, endian, values):
+    value = b''.join(struct.pack(endian + 'II', round(v * 10000), 10000)
+                     for v in values)
+    return (tag, 5, len(values), value)
+
+
+def dms(degrees):
+    degrees = abs(degrees)
+    minutes = (degrees % 1) * 60
+    return [int(degrees), int(minutes), (minutes % 1) * 60]
+
+
+def tiff(make, model, date, gps, endian='<'):
+    """TIFF with IFD0, Exif and GPS IFDs holding the metadata."""
+    def ifd0(exif, gps_ifd):
+        entries = [ascii_tag(0x10f, make), ascii_tag(0x110, model),
+                   (0x8769, 4, 1, struct.pack(endian + 'I', exif))]
+        if gps:
+            entries.append((0x8825, 4, 1, struct.pack(endian + 'I', gps_ifd)))
+        return tiff_ifd(entries, endian, 8)
+
+    exif_offset = 8 + len(ifd0(0, 0))
+    exif = tiff_ifd([ascii_tag(0x9003, date)], endian, exif_offset)
+    gps_offset = exif_offset + len(exif)
+    out = (b'II' if endian == '<' else b'MM') + \
+        struct.pack(endian + 'HI', 42, 8) + \
+        ifd0(exif_offset, gps_offset) + exif
+    if gps:
+        lat, lon = gps
+        out += tiff_ifd([ascii_tag(1, 'N' if lat >= 0 else 'S'),
+                         rational_tag(2, endian, dms(lat)),
+                         ascii_tag(3, 'E' if lon >= 0 else 'W'),
+                         rational_tag(4, endian, dms(lon))],
+                        endian, gps_offset)
+    return out
+
+
+def jpeg(make, model, date, gps, payload):
+    app1 = b'Exif\0\0' + tiff(make, model, date, gps, '>')
+    return (b'\xff\xd8\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 +
+            b'\xff\xda' + payload + b'\xff\xd9')
+
+
+def atom(kind, payload):
+    return struct.pack('>I', 8 + len(payload)) + kind + payload
+
+
+def mp4(make, model, date, gps, payload):
+    stamp = datetime.datetime.strptime(date, '%Y:%m:%d %H:%M:%S')
+    seconds = int((stamp - datetime.datetime(1904, 1, 1)).total_seconds())
+    mvhd = atom(b'mvhd', b'\0' * 4 + struct.pack('>II', seconds, seconds) +
+                b'\0' * 92)
+    keys = ['com.apple.quicktime.make', 'com.apple.quicktime.model',
+            'com.apple.quicktime.creationdate']
+    values = [make, model, stamp.strftime('%Y-%m-%dT%H:%M:%S+0000')]
+    if gps:
+        keys.append('com.apple.quicktime.location.ISO6709')
+        values.append(f"{gps[0]:+08.4f}{gps[1]:+09.4f}/")
+    key_atoms = b''.join(struct.pack('>I', 8 + len(k)) + b'mdta' + k.encode()
+                         for k in keys)
+    items = b''.join(atom(struct.pack('>I', i + 1),
+                          atom(b'data', struct.pack('>II', 1, 0) + v.encode()))
+                     for i, v in enumerate(values))
+    meta = atom(b'meta', atom(b'hdlr', b'\0' * 25) +
+                atom(b'keys', b'\0' * 4 + struct.pack('>I', len(keys)) +
+                     key_atoms) + atom(b'ilst', items))
+    return (atom(b'ftyp', b'mp42\0\0\0\0mp42isom') + atom(b'mdat', payload) +
+            atom(b'moov', mvhd + meta))
+
+
+def generate_pool(pool, args, rng):
+    """Write the shots to POOL, returns the number of files."""
+    cameras = [c.split('/', 1) for c in args.cameras.split(',')]
+    start = datetime.datetime(2023, 5, 1, 8)
+    count = 0
+    for i in range(args.shots + args.videos):
+        make, model = cameras[i % len(cameras)]
+        date = start + datetime.timedelta(
+            days=rng.randrange(args.days), seconds=rng.randrange(36000))
+        date = date.strftime('%Y:%m:%d %H:%M:%S')
+        gps = (args.lat + rng.uniform(-args.spread, args.spread),
+               args.lon + rng.uniform(-args.spread, args.spread))
+        payload = rng.randbytes(args.size * 1024)
+        directory = os.path.join(pool, 'DCIM', f'{100 + i // 999}BENCH')
+        os.makedirs(directory, exist_ok=True)
+        name = os.path.join(directory, f'IMG_{i:05d}')
+        files = {}
+        if i >= args.shots:
+            files['.MP4'] = mp4(make, model, date, gps, payload)
+        elif make == 'Apple':
+            files['.JPG'] = jpeg(make, model, date, gps, payload)
+        else:
+            raw = RAW_EXTENSIONS.get(make, '.DNG')
+            files[raw] = tiff(make, model, date, gps) + payload
+            if rng.random() < args.pairs:
+                files['.JPG'] = jpeg(make, model, date, gps, payload)
+        for ext, data in files.items():
+            with open(name + ext, 'wb') as f:
+                f.write(data)
+        count += len(files)
+    return count
+
+
+def generate_destination(dest, args, rng):
+    """Add existing events to DEST for some of the dates in the pool."""
+    filter_make = picmover.CameraFilter(picmover.MAKE_RULES)
+    filter_model = picmover.CameraFilter(picmover.MODEL_RULES)
+    cameras = [c.split('/', 1) for c in args.cameras.split(',')]
+    start = datetime.date(2023, 5, 1)
+    for i in range(args.existing):
+        make, model = cameras[i % len(cameras)]
+        date = start + datetime.timedelta(days=rng.randrange(-365, args.days))
+        path = os.path.join(dest, 'Image', filter_make(make),
+                            filter_model(model), str(date.year),
+                            f'{date} Event {i}', 'JPEG')
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, f'OLD_{i:05d}.JPG'), 'wb') as f:
+            f.write(b'\xff\xd8\xff\xd9')
+
+
+class Geocoder(http.server.BaseHTTPRequestHandler):
+    """Stub of Nominatim's reverse endpoint."""
+
+    requests = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with Geocoder.lock:
+            Geocoder.requests += 1
+        body = (b'<?xml version="1.0" encoding="UTF-8"?><reversegeocode>'
+                b'<result>Bench Road, Bench City, Sweden</result>'
+                b'<addressparts><road>Bench Road</road>'
+                b'<city>Bench City</city><country>Sweden</country>'
+                b'</addressparts></reversegeocode>')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def run(mode, args, work, template, config):
+    """Import the pool once, returns (seconds, stage report)."""
+    dest = os.path.join(work, 'dest')
+    shutil.rmtree(dest, ignore_errors=True)
+    shutil.copytree(template, dest)
+    if not args.warm:
+        shutil.rmtree(os.path.join(work, 'cache'), ignore_errors=True)
+    pm = picmover.PicMover(
+        config, os.path.join(work, 'pool'), ['city'] if args.gps else None,
+        dry_run=mode == 'dry-run', match=[0] if args.gps else None,
+        jobs=args.jobs, copy_jobs=args.copy_jobs,
+        exif_reader=args.exif_reader,
+        rules=None if args.gps else os.path.join(work, 'rules'),
+        profile=os.path.join(work, 'profile.json'))
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        pm.exe()
+        elapsed = time.perf_counter() - start
+    return elapsed, pm.profiler.report()['stages']
+
+
+def compare(old, new):
+    for mode, result in new['modes'].items():
+        before = old.get('modes', {}).get(mode)
+        if before is None:
+            continue
+        change = (result['elapsed'] / before['elapsed'] - 1) * 100
+        print(f"{mode}: {before['elapsed']:.3f} s -> "
+              f"{result['elapsed']:.3f} s ({change:+.0f}%)")
+        for name, stage in result['stages'].items():
+            if name in before['stages'] and before['stages'][name]['total']:
+                change = (stage['total'] /
+                          before['stages'][name]['total'] - 1) * 100
+                print(f"  {name:<14}{change:+.0f}%")
+
+
+def version():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--shots", type=int, default=500,
+                        help="Number of photos.")
+    parser.add_argument("--videos", type=int, default=20,
+                        help="Number of videos.")
+    parser.add_argument("--cameras", default=CAMERAS,
+                        help="Comma separated MAKE/MODEL of the cameras, "
+                        "Apple cameras only shoot JPEG.")
+    parser.add_argument("--pairs", type=float, default=0.5,
+                        help="Fraction of the raws with a JPEG.")
+    parser.add_argument("--days", type=int, default=10,
+                        help="Number of days the shots are spread over.")
+    parser.add_argument("--lat", type=float, default=59.33)
+    parser.add_argument("--lon", type=float, default=18.07)
+    parser.add_argument("--spread", type=float, default=0.5,
+                        help="GPS spread in degrees around LAT, LON.")
+    parser.add_argument("--size", type=int, default=64,
+                        help="KiB of image data in each file.")
+    parser.add_argument("--existing", type=int, default=200,
+                        help="Number of events already at the destination.")
+    parser.add_argument("--gps", action="store_true",
+                        help="Name the events after the location.")
+    parser.add_argument("--modes", default="dry-run,copy",
+                        help="Comma separated modes: dry-run and copy.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--copy-jobs", type=int, default=4)
+    parser.add_argument("--exif-reader", default='fast',
+                        choices=['gexiv2', 'fast'])
+    parser.add_argument("--warm", action="store_true",
+                        help="Keep the caches between the rounds.")
+    parser.add_argument("-r", "--rounds", type=int, default=3,
+                        help="Number of rounds, the best is reported.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", default="bench-results.json",
+                        help="Where to write the results.")
+    parser.add_argument("--compare", help="Results of an earlier run.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Geocoder)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    work = tempfile.mkdtemp(prefix='picmover-bench-')
+    try:
+        files = generate_pool(os.path.join(work, 'pool'), args, rng)
+        template = os.path.join(work, 'template')
+        generate_destination(template, args, rng)
+        with open(os.path.join(work, 'rules'), 'w') as f:
+            f.write("Event * Bench\n")
+        config = os.path.join(work, 'picmoverrc')
+        with open(config, 'w') as f:
+            f.write(f"Root {work}/dest\n"
+                    f"CacheDir {work}/cache\n"
+                    f"GeocodeURL http://127.0.0.1:{server.server_port}"
+                    "/reverse\n"
+                    "GeocodeRate 1000\n"
+                    "GeocodeWorkers 4\n")
+
+        sys.stdin = open(os.devnull)
+        results = {}
+        for mode in args.modes.split(','):
+            rounds = []
+            for _ in range(args.rounds):
+                rounds.append(run(mode, args, work, template, config))
+            elapsed, stages = min(rounds, key=lambda r: r[0])
+            results[mode] = {'elapsed': elapsed,
+                             'rounds': [r[0] for r in rounds],
+                             'files_per_s': files / elapsed,
+                             'stages': stages}
+            print(f"{mode}: {files} files in {elapsed:.3f} s "
+                  f"({files / elapsed:.0f} files/s)")
+    finally:
+        server.shutdown()
+        shutil.rmtree(work)
+
+    output = {'version': version(),
+              'python': platform.python_version(),
+              'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'params': vars(args),
+              'files': files,
+              'geocode_requests': Geocoder.requests,
+              'modes': results}
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+        f.write('\n')
+    print(f"Wrote {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), output)
+
+
+if __name__ == "__main__":
+    main()
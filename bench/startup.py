@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+
+# SPDX-FileCopyrightText: 2023 Fredrik Salomonsson <plattfot@posteo.net>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Measure how long picmover takes to start when there is nothing to do.
+
+Runs picmover in a new interpreter for importing the module, --help
+and importing from an empty pool, the cases where it exits before
+looking at any file, and reports the best and median time of each.
+Also lists which of the slow modules (gi, http.client, ElementTree,
+multiprocessing) importing picmover and importing from an empty pool
+load. With --rev the picmover.py
+from that git revision is measured as well, for comparison.
+
+Usage: startup.py [-r ROUNDS] [--rev REV]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SLOW_MODULES = ('gi', 'gi.repository.GExiv2', 'gi.repository.Notify',
+                'http.client', 'xml.etree.ElementTree', 'multiprocessing')
+
+# Printed to stderr, picmover prints to stdout.
+PRINT_LOADED = (f"print(' '.join(m for m in {SLOW_MODULES!r} "
+                "if m in sys.modules), file=sys.stderr)")
+
+LOADED = ("import sys; sys.path.insert(0, sys.argv[1]); import picmover; "
+          + PRINT_LOADED)
+
+# Runs the script in sys.argv[1] with the rest of the arguments.
+RUN_LOADED = ("import runpy, sys\n"
+              "sys.argv = sys.argv[1:]\n"
+              "try:\n"
+              "    runpy.run_path(sys.argv[0], run_name='__main__')\n"
+              "except SystemExit:\n"
+              "    pass\n" + PRINT_LOADED)
+
+
+def commands(directory, work):
+    script = os.path.join(directory, 'picmover.py')
+    config = os.path.join(work, 'picmoverrc')
+    return {
+        'import': [sys.executable, '-c',
+                   'import sys; sys.path.insert(0, sys.argv[1]); '
+                   'import picmover', directory],
+        'help': [sys.executable, script, '--help'],
+        'empty pool': [sys.executable, script, '-n', '-c', config,
+                       '-p', os.path.join(work, 'pool')],
+    }
+
+
+def time_command(command, rounds, env):
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = subprocess.run(command, env=env, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE)
+        times.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            return None, result.stderr.decode().strip().splitlines()[-1]
+    return times, None
+
+
+# The slow modules loaded by running COMMAND, None if it failed.
+def slow_modules(command, env):
+    result = subprocess.run(command, env=env, stdin=subprocess.DEVNULL,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    lines = result.stderr.splitlines()
+    return (lines[-1] if lines else '') or 'none'
+
+
+def measure(name, directory, work, rounds, env):
+    print(f"{name}:")
+    cases = commands(directory, work)
+    for case, command in (
+            ('import', [sys.executable, '-c', LOADED, directory]),
+            ('empty pool', [sys.executable, '-c', RUN_LOADED]
+             + cases['empty pool'][1:])):
+        loaded = slow_modules(command, env)
+        if loaded is not None:
+            print(f"  slow modules loaded by {case}: {loaded}")
+    results = {}
+    for case, command in cases.items():
+        times, error = time_command(command, rounds, env)
+        if times is None:
+            print(f"  {case:<11} failed: {error}")
+            continue
+        results[case] = min(times)
+        print(f"  {case:<11} best {min(times) * 1000:6.1f} ms, "
+              f"median {statistics.median(times) * 1000:6.1f} ms")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-r", "--rounds", type=int, default=20,
+                        help="Number of runs of each case.")
+    parser.add_argument("--rev",
+                        help="Git revision of picmover.py to compare with.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work:
+        os.mkdir(os.path.join(work, 'pool'))
+        with open(os.path.join(work, 'picmoverrc'), 'w') as f:
+            f.write(f"Root {os.path.join(work, 'dest')}\n")
+        env = dict(os.environ, XDG_CACHE_HOME=os.path.join(work, 'cache'))
+
+        current = measure("working tree", REPO, work, args.rounds, env)
+        if args.rev is None:
+            return
+        old_dir = os.path.join(work, 'rev')
+        os.mkdir(old_dir)
+        with open(os.path.join(old_dir, 'picmover.py'), 'wb') as f:
+            f.write(subprocess.run(['git', 'show', f'{args.rev}:picmover.py'],
+                                   cwd=REPO, check=True,
+                                   capture_output=True).stdout)
+        old = measure(args.rev, old_dir, work, args.rounds, env)
+        for case in current:
+            if case in old:
+                print(f"{case}: {old[case] / current[case]:.2f}x faster")
+
+
+if __name__ == "__main__":
+    main()
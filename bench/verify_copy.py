@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+
+# SPDX-FileCopyrightText: 2023 Fredrik Salomonsson <plattfot@posteo.net>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Compare the throughput of a plain copy with a verified copy.
+
+Copies the files in SRC to DEST, once with the fastest copy method the
+file systems support and once hashing the data, flushing it and
+reading it back. Use a DEST on the disk you import to, on a tmpfs
+nothing is read back from a disk. Without SRC random files are
+generated next to DEST.
+
+Usage: verify_copy.py [-r ROUNDS] [-s SRC] [-n FILES] [-m MIB] DEST
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import picmover  # noqa: E402
+
+
+def generate(directory, files, size):
+    for i in range(files):
+        with open(os.path.join(directory, f"DSC_{i:04d}.NEF"), 'wb') as f:
+            f.write(os.urandom(size))
+
+
+def time_copy(paths, dest, verify, rounds):
+    engine = picmover.CopyEngine(verify=verify)
+    best = None
+    for _ in range(rounds):
+        target = tempfile.mkdtemp(dir=dest)
+        start = time.perf_counter()
+        for path in paths:
+            engine.copy(path, os.path.join(target, os.path.basename(path)))
+        os.sync()
+        elapsed = time.perf_counter() - start
+        shutil.rmtree(target)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("dest", help="Directory to copy the files to.")
+    parser.add_argument("-s", "--src", help="Directory with files to copy.")
+    parser.add_argument("-n", "--files", type=int, default=20,
+                        help="Number of files to generate.")
+    parser.add_argument("-m", "--size", type=int, default=25,
+                        help="Size of the generated files in MiB.")
+    parser.add_argument("-r", "--rounds", type=int, default=3,
+                        help="Number of rounds, the best is reported.")
+    args = parser.parse_args()
+
+    src = args.src or tempfile.mkdtemp(dir=args.dest)
+    try:
+        if args.src is None:
+            generate(src, args.files, args.size * 1024 * 1024)
+        paths = [e.path for e in os.scandir(src) if e.is_file()]
+        if not paths:
+            sys.exit("No files found.")
+        total = sum(os.path.getsize(p) for p in paths)
+
+        plain = time_copy(paths, args.dest, False, args.rounds)
+        verified = time_copy(paths, args.dest, True, args.rounds)
+    finally:
+        if args.src is None:
+            shutil.rmtree(src)
+
+    print(f"{len(paths)} files, {picmover.format_size(total)}, "
+          f"best of {args.rounds} rounds")
+    print(f"plain:    {plain:.3f} s "
+          f"({picmover.format_size(total / plain)}/s)")
+    print(f"verified: {verified:.3f} s "
+          f"({picmover.format_size(total / verified)}/s)")
+    print(f"overhead: {(verified / plain - 1) * 100:.0f}%")
+
+
+if __name__ == "__main__":
+    main()
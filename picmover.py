@@ -6,31 +6,42 @@
 
 import os
 import shutil  # moving and deleting files
-import glob    # get files from a directory
+import tempfile
 
 # Should be read from a .config file later on
 import sys
 import argparse
 import datetime
 import re
-import gi
-try:
-    # for extracting metadata from jpeg and raw image files
-    gi.require_version('GExiv2', '0.16')
-    from gi.repository import GExiv2
-except ImportError:
-    exit('You need to install gexiv2 first.')
-try:
-    gi.require_version('Notify', '0.7')
-    from gi.repository import Notify
-    HAS_NOTIFY_SUPPORT = True
-except ImportError:
-    HAS_NOTIFY_SUPPORT = False
-# For gps
-from urllib.request import urlopen
-import xml.etree.ElementTree as ET
-
-from collections import defaultdict
+import json
+import sqlite3
+import time
+import errno
+import fcntl
+import mmap
+import struct
+import math
+import bisect
+import hashlib
+import filecmp
+import fnmatch
+import itertools
+import contextlib
+import cProfile
+import threading
+import ctypes
+import select
+import functools
+import array
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
+# GExiv2 and Notify are loaded through gi, which takes longer than the
+# rest of the imports together, and the geocoding needs http.client
+# and ElementTree. They are imported when first used instead, see
+# gexiv2, notifications and GeocodeStage, so --help, config errors
+# and empty pools don't pay for them.
+
+from collections import defaultdict, deque
 
 from sys import exit
 from collections import namedtuple
@@ -38,7 +49,44 @@ from collections import namedtuple
 ##############################################
 FileData = namedtuple(
     "FileData",
-    "key, date, make, model, filetype, target_path")
+    "key, date, make, model, gps, filetype, target_path")
+
+# Plain record of the metadata picmover needs from a file, cheap to
+# pass between processes.
+FileMeta = namedtuple("FileMeta", "make, model, date, gps")
+
+# Result of a reverse geocoding, display is the full address, parts
+# maps the addressparts (road, city, country, ...) to their names.
+# error is set instead if the location couldn't be found.
+Address = namedtuple("Address", "display, parts, error")
+
+# One file of an import plan, action is copy, move, ignore (the event
+# was ignored) or skip (already in the library).
+PlanEntry = namedtuple("PlanEntry", "src, key, dst, action")
+
+# A file found in the image pool. stat is from the scan of the pool so
+# the file doesn't need to be stat'ed again.
+PoolFile = namedtuple("PoolFile", "name, path, filetype, stat")
+
+RAW_EXTENSIONS = ('.3fr', '.ari', '.arw', '.bay', '.crw', '.cr2', '.cap',
+                  '.dcs', '.dcr', '.dng', '.drf', '.eip', '.erf', '.fff',
+                  '.iiq', '.k25', '.kdc', '.mdc', '.mef', '.mos', '.mrw',
+                  '.nef', '.nrw', '.obm', '.orf', '.pef', '.ptx', '.pxn',
+                  '.r3d', '.raf', '.raw', '.rwl', '.rw2', '.rwz', '.sr2',
+                  '.srf', '.srw', '.x3f')
+
+# Maps a lower case file extension to the type of the file.
+FILETYPES = dict.fromkeys(RAW_EXTENSIONS, 'RAW')
+FILETYPES.update({'.jpg': 'JPG', '.jpeg': 'JPG',
+                  '.mov': 'MOV', '.mp4': 'MOV'})
+
+# Kind of metadata each type of file has, files of the same kind and
+# name are assumed to be the same shot, e.g. RAW+JPEG.
+FILEKINDS = {'RAW': 'img', 'JPG': 'img', 'MOV': 'mov'}
+
+# Sidecar files follow the file with the same name, mapped to the kind
+# of file they prefer to follow if there are both.
+SIDECARS = {'.xmp': 'img', '.thm': 'mov'}
 
 __doc__ = """PicMover: Simple class that extracts metadata from an
 image pool and moves them to a dir named with date and user comment.
@@ -59,57 +107,153 @@ def yesNo(x):
         return False
 
 
-def getMetadata(metadata, key, default='Unknown'):
+@functools.cache
+def gexiv2():
+    """Return the GExiv2 module, importing it on the first call."""
     try:
-        return metadata.try_get_tag_string(key)
-    except gi.repository.GLib.Error:
-        print(f"[Error] Exif data '{key}' doesn't exist in img!\
-Returning '{default}'.")
-        return default
+        # for extracting metadata from jpeg and raw image files
+        import gi
+        gi.require_version('GExiv2', '0.16')
+        from gi.repository import GExiv2
+    except (ImportError, ValueError):
+        exit('You need to install gexiv2 first.')
+    return GExiv2
+
+
+@functools.cache
+def notifications():
+    """Return the initialized Notify module, None if it's missing."""
+    try:
+        import gi
+        gi.require_version('Notify', '0.7')
+        from gi.repository import Notify
+    except (ImportError, ValueError):
+        return None
+    Notify.init("picmover")
+    return Notify
 
 
-# TODO: Add that you can add custom mappings in the config file or
-# similar file instead of editing this all the time. Something like
-# Apple[0-9+-,]+ -> Apple
-# Or maybe xml or something.
-class FilterMake:
-    def __init__(self):
-        self.apple_re = re.compile("Apple[0-9+-.]+")
-        self.nikon_re = re.compile("Nikon", re.IGNORECASE)
-        self.lg_re = re.compile("LGE")
-        self.asus = re.compile("asus")
-
-    def __call__(self, make):
-        # For iphone 4, apple appends some sort of id after the make
-        # so just remove that.
-        if re.search(self.apple_re, make):
-            make = 'Apple'
-        elif re.search(self.nikon_re, make):
-            # Choose first ( remove corporation from nikon)
-            make = 'Nikon'
-        elif re.search(self.lg_re, make):
-            make = 'LG'
-        elif re.search(self.asus, make):
-            make = 'Asus'
-        return make
-
-
-class FilterModel:
-    def __init__(self):
-        self.iphone_re = re.compile("iPhone ([0-9s]+)-[0-9+-.]+")
-        self.nikon_re = re.compile("NIKON (D[0-9]+|Z [0-9_]+)", re.IGNORECASE)
+# Exception GExiv2 raises for tags it cannot read, nothing else can
+# raise it so there is nothing to catch until GExiv2 is loaded.
+def glib_error():
+    if not gexiv2.cache_info().currsize:
+        return ()
+    from gi.repository import GLib
+    return GLib.Error
 
-    def __call__(self, model):
-        # For iphone 4, apple appends some sort of id after the model
-        # so just remove that.
-        match = re.search(self.iphone_re, model)
-        if match:
-            return f'iPhone {match.group(1)}'
 
-        match = re.search(self.nikon_re, model)
-        if match:
-            return match.group(1)
-        return model
+def getMetadata(metadata, key, default='Unknown'):
+    try:
+        value = metadata.try_get_tag_string(key)
+    except glib_error():
+        value = None
+    if value is None:
+        print(f"[Error] Exif data '{key}' doesn't exist in img!\
+Returning '{default}'.")
+        return default
+    return value
+
+
+# Built-in rules for normalizing the camera make and model, (pattern,
+# replacement). MakeRule and ModelRule in the config are tried first.
+MAKE_RULES = [
+    # For iphone 4, apple appends some sort of id after the make so
+    # just remove that.
+    (r'Apple[0-9+-.]+', 'Apple'),
+    # Choose first ( remove corporation from nikon)
+    (r'(?i:Nikon)', 'Nikon'),
+    (r'LGE', 'LG'),
+    (r'asus', 'Asus'),
+]
+MODEL_RULES = [
+    # Same id after the model for iphone 4.
+    (r'iPhone ([0-9s]+)-[0-9+-.]+', r'iPhone \1'),
+    (r'(?i:NIKON (D[0-9]+|Z [0-9_]+))', r'\1'),
+]
+
+
+class CameraFilter:
+    """Normalize a camera make or model using RULES.
+
+    RULES is a list of (pattern, replacement). The value is replaced
+    by the replacement of the first rule whose pattern is found in it,
+    the replacement can refer to the groups of the pattern, e.g. \\1.
+    The patterns are compiled into one regex, and the result for each
+    value is remembered as a pool usually only has a few cameras.
+    """
+
+    def __init__(self, rules):
+        alternatives = []
+        # name of the group around the pattern -> replacement
+        self.replacements = {}
+        group = 1
+        for i, (pattern, replacement) in enumerate(rules):
+            pattern = self.scope_flags(pattern)
+            try:
+                groups = re.compile(pattern).groups
+            except re.error as e:
+                raise RuntimeError(
+                    f"[Error] Invalid camera rule {pattern}: {e}")
+            # Each alternative skips ahead itself so the rules are
+            # tried in order, not the one matching first in the value.
+            alternatives.append(
+                f".*?(?P<rule{i}>{self.renumber_pattern(pattern, group)})")
+            # The groups of the pattern come after the one around it.
+            self.replacements[f'rule{i}'] = self.renumber(replacement,
+                                                          group)
+            group += groups + 1
+        try:
+            self.regex = re.compile('|'.join(alternatives), re.DOTALL) \
+                if rules else None
+        except re.error as e:
+            raise RuntimeError(f"[Error] Invalid camera rules: {e}")
+        self.cache = {}
+
+    def __call__(self, value):
+        try:
+            return self.cache[value]
+        except KeyError:
+            pass
+        match = self.regex.match(value) if self.regex else None
+        result = value if match is None else \
+            match.expand(self.replacements[match.lastgroup])
+        self.cache[value] = result
+        return result
+
+    # Global flags are only allowed at the start of the combined
+    # regex, turn flags leading PATTERN into flags for it alone.
+    @staticmethod
+    def scope_flags(pattern):
+        match = re.match(r'\(\?([imsx]+)\)', pattern)
+        if match is None:
+            return pattern
+        return f'(?{match.group(1)}:{pattern[match.end():]})'
+
+    # Shift the backreferences (\N) in PATTERN by OFFSET. Escapes and
+    # character classes are skipped, an octal escape like \101 is not
+    # a backreference. Named backreferences keep working as they are.
+    @staticmethod
+    def renumber_pattern(pattern, offset):
+        def shift(m):
+            if m.group(1) is None:
+                return m.group(0)
+            number = offset + int(m.group(1))
+            if number > 99:
+                raise RuntimeError(
+                    f"[Error] Camera rule {pattern} refers to group "
+                    f"{m.group(1)}, which is past group 99 once combined "
+                    "with the rules before it")
+            return f'(?:\\{number})'
+        return re.sub(r'\[\^?\]?(?:\\.|[^\]\\])*\]|\\[0-7]{3}|'
+                      r'\\([1-9][0-9]?)|\\.', shift, pattern,
+                      flags=re.DOTALL)
+
+    # Shift the group references in REPLACEMENT by OFFSET.
+    @staticmethod
+    def renumber(replacement, offset):
+        def shift(m):
+            return f'\\g<{offset + int(m.group(1) or m.group(2))}>'
+        return re.sub(r'\\([0-9]+)|\\g<([0-9]+)>', shift, replacement)
 
 
 def extract_timestamp(filename):
@@ -127,14 +271,538 @@ def extract_timestamp(filename):
     return ""
 
 
+# Date to use for a file that has no date in its metadata.
+def fallback_date(filename):
+    print(f"[Warning] Couldn't find date for {filename}!")
+    print("          Checking the filename for timestamp")
+    date = extract_timestamp(filename)
+    if not date:
+        print("          Found no valid timestamp,\n"
+              "          using today's date instead.")
+        date = f'{datetime.datetime.today():%Y:%m:%d}'
+    else:
+        print("          Found valid timestamp, using that.")
+    return date
+
+
+def load_rules(path):
+    """Read the rules answering the prompts for events from PATH.
+
+    Each line is a rule, the first matching the date of the event is
+    used. DATE is a shell pattern, e.g. 2023-05-1*:
+      Event DATE NAME  - create the event "DATE NAME"
+      Ignore DATE      - ignore the files
+      Match DATE N     - use match N of the existing events
+    """
+    rules = []
+    with open(os.path.expanduser(path)) as f:
+        for lineno, line in enumerate(f, 1):
+            data = line.split(maxsplit=2)
+            if not data or data[0].startswith('#'):
+                continue
+            if data[0] == "Event" and len(data) == 3:
+                rules.append((data[1], 'n', data[2].strip()))
+            elif data[0] == "Ignore" and len(data) == 2:
+                rules.append((data[1], 'i', None))
+            elif data[0] == "Match" and len(data) == 3 and \
+                    data[2].strip().isdigit():
+                rules.append((data[1], data[2].strip(), None))
+            else:
+                raise RuntimeError(
+                    f"[Error] {path}:{lineno}: Invalid rule: {line.strip()}")
+    return rules
+
+
+class PlanWriter:
+    """Write a plan to PATH one PlanEntry at a time.
+
+    The plan is written as TSV if the file ends with .tsv, otherwise
+    as JSON. It's written next to PATH and renamed once closed so an
+    interrupted plan doesn't replace an earlier one.
+    """
+
+    def __init__(self, path, pools):
+        self.path = path
+        self.tsv = path.endswith('.tsv')
+        self.count = 0
+        self.file = open(f'{path}.part', 'w')
+        if self.tsv:
+            self.file.write('# ' + '\t'.join(PlanEntry._fields) + '\n')
+        else:
+            pools = json.dumps([os.path.abspath(p) for p in pools])
+            self.file.write(f'{{"pools": {pools},\n "files": [')
+
+    def add(self, entry):
+        if self.tsv:
+            self.file.write('\t'.join(entry) + '\n')
+        else:
+            self.file.write((',' if self.count else '') + '\n  ' +
+                            json.dumps(entry._asdict()))
+        self.count += 1
+
+    def close(self):
+        if not self.tsv:
+            self.file.write('\n ]}\n')
+        self.file.close()
+        os.replace(f'{self.path}.part', self.path)
+
+
+def read_plan(path):
+    entries = []
+    with open(path) as f:
+        if path.endswith('.tsv'):
+            for line in f:
+                if not line.strip() or line.startswith('#'):
+                    continue
+                entries.append(PlanEntry(*line.rstrip('\n').split('\t')))
+        else:
+            entries = [PlanEntry(**entry) for entry in json.load(f)['files']]
+    for entry in entries:
+        if entry.action not in ('copy', 'move', 'ignore', 'skip'):
+            raise RuntimeError(f"[Error] Unknown action {entry.action} "
+                               f"for {entry.src} in {path}")
+    return entries
+
+
+def group_files(files, sidecars):
+    """Group FILES from one directory into shots.
+
+    FILES are grouped by name and kind, with the RAW first, so the
+    metadata only needs to be read from the first file of a group.
+    SIDECARS, a list of (stem, PoolFile), are added to the group they
+    belong to and get the same filetype as its first file. Sidecars
+    without a group are dropped.
+    """
+    order = list(FILEKINDS)
+    groups = defaultdict(list)
+    for entry in files:
+        stem = os.path.splitext(entry.name)[0]
+        groups[(stem, FILEKINDS[entry.filetype])].append(entry)
+    for group in groups.values():
+        group.sort(key=lambda entry: (order.index(entry.filetype),
+                                      entry.name))
+
+    for stem, entry in sidecars:
+        # darktable names them DSC_0001.NEF.xmp
+        base, ext = os.path.splitext(stem)
+        if ext.lower() in FILETYPES:
+            stem = base
+        kind = SIDECARS[os.path.splitext(entry.name)[1].lower()]
+        other = 'mov' if kind == 'img' else 'img'
+        group = groups.get((stem, kind)) or groups.get((stem, other))
+        if group is not None:
+            group.append(entry._replace(filetype=group[0].filetype))
+    return [groups[k] for k in sorted(groups)]
+
+
+def scan_pool(path, recursive=True):
+    """Yield the images and videos under PATH, grouped into shots.
+
+    Each group is a list of PoolFile, see group_files. The pool is
+    walked recursively unless RECURSIVE is false, so camera layouts
+    like DCIM/100NIKON work. The groups in each directory are yielded
+    sorted by name, hidden files and directories are skipped. Files
+    from different directories can have the same name, e.g. once the
+    file counter of the camera wraps, see PicMover.claim_name.
+    """
+    stack = [path]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except OSError as e:
+            print(f"[Warning] Couldn't read {d}: {e.strerror}")
+            continue
+        subdirs = []
+        files = []
+        sidecars = []
+        with it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    if recursive:
+                        subdirs.append(entry.path)
+                    continue
+                stem, ext = os.path.splitext(entry.name)
+                ext = ext.lower()
+                filetype = FILETYPES.get(ext)
+                if (filetype is None and ext not in SIDECARS) or \
+                   not entry.is_file():
+                    continue
+                f = PoolFile(entry.name, entry.path, filetype, entry.stat())
+                if filetype is None:
+                    sidecars.append((stem, f))
+                else:
+                    files.append(f)
+        yield from group_files(files, sidecars)
+        stack.extend(sorted(subdirs, reverse=True))
+
+
+def scan_pools(pools):
+    """Yield the groups of the files in POOLS, see scan_pool.
+
+    Pools on different devices are taken in turn, one group at a time,
+    so they are read at the same time. Pools on the same device are
+    scanned one after the other to keep the reads sequential.
+    """
+    devices = defaultdict(list)
+    for pool in pools:
+        try:
+            devices[os.stat(pool).st_dev].append(pool)
+        except OSError as e:
+            print(f"[Warning] Couldn't read {pool}: {e.strerror}")
+    scans = deque(itertools.chain.from_iterable(map(scan_pool, paths))
+                  for paths in devices.values())
+    while scans:
+        scan = scans.popleft()
+        for group in scan:
+            yield group
+            scans.append(scan)
+            break
+
+
+class HeaderError(ValueError):
+    pass
+
+
+class TiffError(HeaderError):
+    pass
+
+
+class TiffMetadata:
+    """Minimal EXIF reader for JPEG and TIFF based raw files.
+
+    Only the IFDs picmover needs (IFD0, Exif and GPS) are parsed,
+    straight from a mmap of the file, so only the pages holding them
+    are read from disk. Implements the parts of GExiv2.Metadata that
+    ExifImg uses. Raises TiffError if it cannot parse the file, use
+    GExiv2 for those.
+    """
+
+    # TIFF magic numbers, 42 for plain TIFF (NEF, CR2, ARW, DNG, PEF,
+    # ...), ORF and RW2 use their own.
+    MAGIC = (42, 0x4F52, 0x5352, 0x55)
+    # Size in bytes of each TIFF field type.
+    TYPE_SIZE = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8, 13: 4}
+    EXIF_IFD = 0x8769
+    GPS_IFD = 0x8825
+    # GExiv2 tag name -> (ifd, tag id)
+    TAGS = {
+        'Exif.Image.Make': ('image', 0x010F),
+        'Exif.Image.Model': ('image', 0x0110),
+        'Exif.Image.DateTimeOriginal': ('image', 0x9003),
+        'Exif.Photo.DateTimeOriginal': ('photo', 0x9003),
+        'Exif.GPSInfo.GPSLatitudeRef': ('gps', 1),
+        'Exif.GPSInfo.GPSLatitude': ('gps', 2),
+        'Exif.GPSInfo.GPSLongitudeRef': ('gps', 3),
+        'Exif.GPSInfo.GPSLongitude': ('gps', 4),
+    }
+    # GExiv2 tag name -> (type, count or None for any) the value must
+    # have, files where it doesn't are left to GExiv2.
+    FORMATS = {
+        'Exif.GPSInfo.GPSLatitudeRef': (2, None),
+        'Exif.GPSInfo.GPSLatitude': (5, 3),
+        'Exif.GPSInfo.GPSLongitudeRef': (2, None),
+        'Exif.GPSInfo.GPSLongitude': (5, 3),
+    }
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as e:
+                raise TiffError(f"Cannot map '{path}': {e}")
+        try:
+            self.tags = self.parse(data)
+        except (struct.error, IndexError, KeyError) as e:
+            raise TiffError(f"Corrupt EXIF in '{path}': {e}")
+        finally:
+            data.close()
+
+    @staticmethod
+    def find_exif(data):
+        """Return the offset of the TIFF header in the JPEG DATA."""
+        pos = 2
+        while pos + 4 <= len(data):
+            if data[pos] != 0xFF:
+                raise TiffError("Invalid JPEG marker")
+            marker = data[pos + 1]
+            if marker == 0xFF:
+                pos += 1
+                continue
+            if marker in (0xD9, 0xDA):
+                break
+            if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+                pos += 2
+                continue
+            length, = struct.unpack_from('>H', data, pos + 2)
+            if marker == 0xE1 and data[pos + 4:pos + 10] == b'Exif\0\0':
+                return pos + 10
+            pos += 2 + length
+        raise TiffError("No EXIF in JPEG")
+
+    def parse(self, data):
+        base = self.find_exif(data) if data[:2] == b'\xff\xd8' else 0
+        order = data[base:base + 2]
+        if order == b'II':
+            endian = '<'
+        elif order == b'MM':
+            endian = '>'
+        else:
+            raise TiffError("Not a TIFF file")
+        magic, ifd0 = struct.unpack_from(endian + 'HI', data, base + 2)
+        if magic not in self.MAGIC:
+            raise TiffError("Not a TIFF file")
+
+        ifds = {'image': self.read_ifd(data, base, endian, ifd0)}
+        for name, pointer in (('photo', self.EXIF_IFD),
+                              ('gps', self.GPS_IFD)):
+            entry = ifds['image'].get(pointer)
+            ifds[name] = {}
+            if entry is not None:
+                kind, n, pos = entry
+                if kind not in (4, 13) or n != 1:
+                    raise TiffError("Invalid IFD pointer")
+                offset, = struct.unpack_from(endian + 'I', data, pos)
+                ifds[name] = self.read_ifd(data, base, endian, offset)
+
+        tags = {}
+        for key, (ifd, tag) in self.TAGS.items():
+            entry = ifds[ifd].get(tag)
+            if entry is None:
+                continue
+            kind, n = self.FORMATS.get(key, entry[:2])
+            if entry[0] != kind or n not in (None, entry[1]):
+                raise TiffError(f"Unexpected format of {key}")
+            tags[key] = self.value(data, base, endian, entry)
+        return tags
+
+    # Returns tag -> (type, count, offset of the value) for the IFD at
+    # OFFSET.
+    def read_ifd(self, data, base, endian, offset):
+        pos = base + offset
+        count, = struct.unpack_from(endian + 'H', data, pos)
+        if count > 1000:
+            raise TiffError("Too many IFD entries")
+        entries = {}
+        for i in range(count):
+            entry = pos + 2 + 12 * i
+            tag, kind, n = struct.unpack_from(endian + 'HHI', data, entry)
+            size = self.TYPE_SIZE.get(kind, 1) * n
+            value = entry + 8
+            if size > 4:
+                value = base + struct.unpack_from(endian + 'I', data,
+                                                  value)[0]
+            if value + size > len(data):
+                raise TiffError("IFD entry outside of file")
+            entries[tag] = (kind, n, value)
+        return entries
+
+    @staticmethod
+    def value(data, base, endian, entry):
+        kind, n, pos = entry
+        if kind == 2:
+            return data[pos:pos + n].split(b'\0')[0].decode('utf-8', 'replace')
+        if kind == 3:
+            return struct.unpack_from(f'{endian}{n}H', data, pos)
+        if kind == 4:
+            return struct.unpack_from(f'{endian}{n}I', data, pos)
+        if kind == 5:
+            values = struct.unpack_from(f'{endian}{2 * n}I', data, pos)
+            return [num / den if den else 0.0
+                    for num, den in zip(values[::2], values[1::2])]
+        return bytes(data[pos:pos + n])
+
+    def try_has_tag(self, key):
+        return key in self.tags
+
+    def try_get_tag_string(self, key):
+        value = self.tags.get(key)
+        return value if value is None or isinstance(value, str) \
+            else str(value)
+
+    def gps_coordinate(self, key, negative):
+        degrees = self.tags[key]
+        value = degrees[0] + degrees[1] / 60 + degrees[2] / 3600
+        if self.tags.get(key + 'Ref', '').upper() == negative:
+            value = -value
+        return value
+
+    def get_gps_latitude(self):
+        return self.gps_coordinate('Exif.GPSInfo.GPSLatitude', 'S')
+
+    def get_gps_longitude(self):
+        return self.gps_coordinate('Exif.GPSInfo.GPSLongitude', 'W')
+
+
+class QuickTimeError(HeaderError):
+    pass
+
+
+class QuickTimeMetadata:
+    """Minimal metadata reader for QuickTime and MP4 files.
+
+    Walks the atoms by seeking past them, only moov/mvhd and the
+    udta and meta atoms are read, so the cost doesn't depend on the
+    size of the video. Implements the parts of GExiv2.Metadata that
+    ExifMov uses. Raises QuickTimeError if it cannot parse the file.
+    """
+
+    # Seconds between 1904-01-01 (QuickTime epoch) and 1970-01-01.
+    EPOCH_OFFSET = 2082844800
+    # Atoms that only contain other atoms and are worth descending into.
+    CONTAINERS = (b'moov', b'udta', b'meta')
+    # Atom or key name -> GExiv2 tag name
+    UDTA_TAGS = {
+        b'\xa9mak': 'Xmp.video.Make',
+        b'\xa9mod': 'Xmp.video.Model',
+        b'\xa9xyz': 'Xmp.video.GPSCoordinates',
+    }
+    KEY_TAGS = {
+        'com.apple.quicktime.make': 'Xmp.video.Make',
+        'com.apple.quicktime.model': 'Xmp.video.Model',
+        'com.apple.quicktime.creationdate': 'Xmp.video.DateTimeOriginal',
+        'com.apple.quicktime.location.ISO6709': 'Xmp.video.GPSCoordinates',
+    }
+    MAX_ATOMS = 10000
+
+    def __init__(self, path):
+        self.tags = {}
+        self.atoms = 0
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            try:
+                if f.read(8)[4:8] not in (b'ftyp', b'moov', b'mdat',
+                                          b'wide', b'free', b'skip'):
+                    raise QuickTimeError("Not a QuickTime file")
+                self.walk(f, 0, size)
+            except (struct.error, UnicodeDecodeError) as e:
+                raise QuickTimeError(f"Corrupt atoms in '{path}': {e}")
+
+    # Yields (type, start of payload, end of atom) for each atom between
+    # START and END.
+    def atoms_in(self, f, start, end):
+        pos = start
+        while pos + 8 <= end:
+            self.atoms += 1
+            if self.atoms > self.MAX_ATOMS:
+                raise QuickTimeError("Too many atoms")
+            f.seek(pos)
+            size, kind = struct.unpack('>I4s', f.read(8))
+            header = 8
+            if size == 1:
+                size, = struct.unpack('>Q', f.read(8))
+                header = 16
+            elif size == 0:
+                size = end - pos
+            if size < header or pos + size > end:
+                raise QuickTimeError("Invalid atom size")
+            yield kind, pos + header, pos + size
+            pos += size
+
+    def walk(self, f, start, end, keys=None):
+        for kind, payload, atom_end in self.atoms_in(f, start, end):
+            if kind == b'mvhd':
+                self.read_mvhd(f, payload)
+            elif kind == b'meta':
+                # The ISO flavour of meta has version and flags before
+                # the children, the QuickTime one doesn't.
+                f.seek(payload + 4)
+                if f.read(4) != b'hdlr':
+                    payload += 4
+                self.walk(f, payload, atom_end, keys)
+            elif kind in self.CONTAINERS:
+                self.walk(f, payload, atom_end, keys)
+            elif kind == b'keys':
+                keys = self.read_keys(f, payload, atom_end)
+            elif kind == b'ilst':
+                self.read_ilst(f, payload, atom_end, keys or [])
+            elif kind in self.UDTA_TAGS and start != 0:
+                self.read_udta_string(f, kind, payload, atom_end)
+            if start == 0 and kind == b'moov':
+                break
+
+    def read_mvhd(self, f, payload):
+        f.seek(payload)
+        version = f.read(4)[0]
+        if version == 1:
+            created, = struct.unpack('>Q', f.read(8))
+        else:
+            created, = struct.unpack('>I', f.read(4))
+        if created > self.EPOCH_OFFSET:
+            date = datetime.datetime.fromtimestamp(
+                created - self.EPOCH_OFFSET, datetime.timezone.utc)
+            self.tags['Xmp.video.CreateDate'] = f'{date:%Y-%m-%dT%H:%M:%S}'
+
+    def read_udta_string(self, f, kind, payload, end):
+        f.seek(payload)
+        length, _ = struct.unpack('>HH', f.read(4))
+        if length > end - payload - 4:
+            # iTunes style, the value is in a data atom.
+            self.read_data(f, self.UDTA_TAGS[kind], payload, end)
+            return
+        self.tags.setdefault(self.UDTA_TAGS[kind],
+                             f.read(length).decode('utf-8'))
+
+    def read_keys(self, f, payload, end):
+        f.seek(payload + 4)
+        count, = struct.unpack('>I', f.read(4))
+        keys = []
+        pos = payload + 8
+        for _ in range(min(count, self.MAX_ATOMS)):
+            if pos + 8 > end:
+                break
+            f.seek(pos)
+            size, _ = struct.unpack('>I4s', f.read(8))
+            if size < 8:
+                raise QuickTimeError("Invalid key size")
+            keys.append(f.read(size - 8).decode('utf-8'))
+            pos += size
+        return keys
+
+    def read_ilst(self, f, start, end, keys):
+        for kind, payload, atom_end in self.atoms_in(f, start, end):
+            index, = struct.unpack('>I', kind)
+            if 0 < index <= len(keys) and keys[index - 1] in self.KEY_TAGS:
+                self.read_data(f, self.KEY_TAGS[keys[index - 1]],
+                               payload, atom_end)
+            elif kind in self.UDTA_TAGS:
+                self.read_data(f, self.UDTA_TAGS[kind], payload, atom_end)
+
+    def read_data(self, f, tag, start, end):
+        for kind, payload, atom_end in self.atoms_in(f, start, end):
+            if kind == b'data':
+                f.seek(payload)
+                data_type, = struct.unpack('>I', f.read(4))
+                f.read(4)
+                value = f.read(atom_end - payload - 8)
+                if data_type == 1:
+                    value = value.decode('utf-8')
+                    if tag == 'Xmp.video.DateTimeOriginal':
+                        # 2023-05-11T10:00:00+0200 -> 2023:05:11 10:00:00
+                        value = value[:19].replace('-', ':').replace('T', ' ')
+                    self.tags[tag] = value
+                return
+
+    def try_has_tag(self, key):
+        return key in self.tags
+
+    def try_get_tag_string(self, key):
+        return self.tags.get(key)
+
+
 class ExifImg:
     """Extract metadata from images"""
 
-    def __init__(self, default_make, default_model):
+    header_reader = TiffMetadata
+
+    def __init__(self, default_make, default_model, filter_make=None,
+                 filter_model=None):
         self.default_make = default_make
         self.default_model = default_model
-        self.filter_model = FilterModel()
-        self.filter_make = FilterMake()
+        self.filter_make = filter_make or CameraFilter(MAKE_RULES)
+        self.filter_model = filter_model or CameraFilter(MODEL_RULES)
 
     def model(self, metadata):
         return self.filter_model(getMetadata(metadata, 'Exif.Image.Model',
@@ -144,26 +812,17 @@ class ExifImg:
         return self.filter_make(getMetadata(metadata, 'Exif.Image.Make',
                                             self.default_make))
 
-    def date(self, metadata, filename):
+    # Returns None if the date is missing, see fallback_date.
+    def date(self, metadata):
         if metadata.try_has_tag('Exif.Image.DateTimeOriginal'):
-            date = metadata.try_get_tag_string(
+            return metadata.try_get_tag_string(
                 'Exif.Image.DateTimeOriginal'
             ).split()[0]
         elif metadata.try_has_tag('Exif.Photo.DateTimeOriginal'):
-            date = metadata.try_get_tag_string(
+            return metadata.try_get_tag_string(
                 'Exif.Photo.DateTimeOriginal'
             ).split()[0]
-        else:
-            print("[Warning] Couldn't find date!")
-            print("          Checking the filename for timestamp")
-            date = extract_timestamp(filename)
-            if not date:
-                print("          Found no valid timestamp,\n"
-                      "          using today's date instead.")
-                date = f'{datetime.datetime.today():%Y:%m:%d}'
-            else:
-                print("          Found valid timestamp, using that.")
-        return date
+        return None
 
     def gps(self, metadata):
         if metadata.try_has_tag('Exif.GPSInfo.GPSLatitude') and\
@@ -176,11 +835,14 @@ class ExifImg:
 class ExifMov:
     """Extract metadata from mov files"""
 
-    def __init__(self, default_make, default_model):
+    header_reader = QuickTimeMetadata
+
+    def __init__(self, default_make, default_model, filter_make=None,
+                 filter_model=None):
         self.default_make = default_make
         self.default_model = default_model
-        self.filter_model = FilterModel()
-        self.filter_make = FilterMake()
+        self.filter_make = filter_make or CameraFilter(MAKE_RULES)
+        self.filter_model = filter_model or CameraFilter(MODEL_RULES)
 
         self.gps_re = re.compile(r"([+-][0-9]+\.[0-9]+)([+-][0-9]+\.[0-9]+)")
 
@@ -192,26 +854,17 @@ class ExifMov:
         return self.filter_make(getMetadata(metadata, 'Xmp.video.Make',
                                             self.default_make))
 
-    def date(self, metadata, filename):
+    # Returns None if the date is missing, see fallback_date.
+    def date(self, metadata):
         if metadata.try_has_tag('Xmp.video.DateTimeOriginal'):
-            date = metadata.try_get_tag_string(
+            return metadata.try_get_tag_string(
                 'Xmp.video.DateTimeOriginal'
             ).split()[0]
         elif metadata.try_has_tag('Xmp.video.CreateDate'):
-            date = metadata.try_get_tag_string(
+            return metadata.try_get_tag_string(
                 'Xmp.video.CreateDate'
             ).split('T')[0]
-        else:
-            print("[Warning] Couldn't find date!")
-            print("          Checking the filename for timestamp")
-            date = extract_timestamp(filename)
-            if not date:
-                print("          Found no valid timestamp,\n"
-                      "          using today's date instead.")
-                date = f'{datetime.datetime.today():%Y:%m:%d}'
-            else:
-                print("          Found valid timestamp, using that.")
-        return date
+        return None
 
     def gps(self, metadata):
         if metadata.try_has_tag('Xmp.video.GPSCoordinates'):
@@ -225,6 +878,1517 @@ class ExifMov:
             return []
 
 
+def read_metadata(path, exif, fast=False):
+    """Read make, model, date and gps from PATH using EXIF.
+
+    If FAST is true the metadata is read using the header reader of
+    EXIF, falling back to GExiv2 for files it cannot parse. The date
+    is None if the file doesn't have one, see fallback_date.
+    """
+    metadata = None
+    if fast:
+        try:
+            metadata = exif.header_reader(path)
+        except HeaderError:
+            pass
+    if metadata is None:
+        metadata = gexiv2().Metadata(path)
+    if not metadata:
+        raise ValueError(f"Unable to open metadata for '{path}'")
+    return FileMeta(exif.make(metadata),
+                    exif.model(metadata),
+                    exif.date(metadata),
+                    exif.gps(metadata) or [])
+
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'picmover')
+
+
+def parse_address(xml):
+    """Return the Address in the reply XML from Nominatim."""
+    if len(xml) == 1:
+        return Address(None, {}, xml[0].text)
+    parts = {elm.tag: elm.text for elm in xml[1]}
+    return Address(xml[0].text, parts, None)
+
+
+# Grid cell of size GRID degrees the coordinates are in.
+def quantize(coords, grid):
+    return (round(float(coords[0]) / grid), round(float(coords[1]) / grid))
+
+
+class GeocodeError(Exception):
+    def __init__(self, msg, retry=False):
+        super().__init__(msg)
+        self.retry = retry
+
+
+class GeocodeStage:
+    """Reverse geocode locations with Nominatim in the background.
+
+    Locations are quantized to the same grid as the geocode cache and
+    each cell is only looked up once. The lookups run on a pool of
+    threads, each keeping its connection open, with at most rate
+    requests per second in total (Nominatim's usage policy allows
+    one). Failed requests are retried with exponential backoff.
+
+    The cache is only used from the thread calling prefetch and get.
+    """
+
+    def __init__(self, url, cache=None, grid=0.001, workers=2, rate=1.0,
+                 retries=3, backoff=1.0):
+        from urllib.parse import urlsplit
+        parts = urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.netloc
+        self.path = parts.path or '/'
+        self.cache = cache
+        self.grid = grid
+        self.retries = retries
+        self.backoff = backoff
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_request = time.monotonic()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # cell -> Address or Future while it's being looked up
+        self.addresses = {}
+
+    def prefetch(self, coords):
+        """Start looking up COORDS unless it's already known."""
+        cell = quantize(coords, self.grid)
+        if cell in self.addresses:
+            return
+        address = self.cache.get(coords) if self.cache is not None else None
+        if address is None:
+            address = self.executor.submit(self.fetch, coords)
+        self.addresses[cell] = address
+
+    def get(self, coords):
+        """Return the Address of COORDS, waiting for the lookup."""
+        self.prefetch(coords)
+        cell = quantize(coords, self.grid)
+        address = self.addresses[cell]
+        if isinstance(address, Future):
+            address = address.result()
+            self.addresses[cell] = address
+            if self.cache is not None:
+                self.cache.put(coords, address)
+        return address
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    # Wait until the rate limit allows another request.
+    def wait_turn(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_request - now
+            self.next_request = max(now, self.next_request) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def request(self, path):
+        import http.client
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            cls = http.client.HTTPSConnection if self.https \
+                else http.client.HTTPConnection
+            connection = self.local.connection = cls(self.host, timeout=30)
+        connection.request('GET', path, headers={'User-Agent': 'picmover'})
+        response = connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise GeocodeError(
+                f"HTTP {response.status} from {self.host}",
+                retry=response.status == 429 or response.status >= 500)
+        return body
+
+    def fetch(self, coords):
+        import http.client
+        from urllib.parse import urlencode
+        import xml.etree.ElementTree as ET
+        query = urlencode({'format': 'xml',
+                           'lat': coords[0],
+                           'lon': coords[1]})
+        for attempt in range(self.retries + 1):
+            self.wait_turn()
+            try:
+                return parse_address(
+                    ET.fromstring(self.request(f"{self.path}?{query}")))
+            except (OSError, http.client.HTTPException, GeocodeError) as e:
+                if isinstance(e, GeocodeError) and not e.retry or \
+                   attempt == self.retries:
+                    raise
+                connection = getattr(self.local, 'connection', None)
+                if connection is not None:
+                    connection.close()
+                self.local.connection = None
+                time.sleep(self.backoff * 2 ** attempt)
+
+
+class GeocodeCache:
+    """SQLite backed cache of reverse geocoding results.
+
+    The coordinates are quantized to a grid with cells of grid
+    degrees (0.001 is roughly 100 m), photos taken within the same
+    cell share the address. Entries older than ttl seconds are
+    ignored, and once the cache holds more than max_entries the least
+    recently used are evicted when it's closed.
+    """
+
+    def __init__(self, path, grid=0.001, ttl=90 * 24 * 3600,
+                 max_entries=100000):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.grid = grid
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.now = int(time.time())
+        self.hits = 0
+        self.misses = 0
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS address ("
+            "grid REAL, lat INTEGER, lon INTEGER, address TEXT, "
+            "created INTEGER, used INTEGER, "
+            "PRIMARY KEY (grid, lat, lon))")
+
+    def cell(self, coords):
+        return (self.grid, *quantize(coords, self.grid))
+
+    def get(self, coords):
+        cell = self.cell(coords)
+        row = self.db.execute(
+            "SELECT address FROM address WHERE grid=? AND lat=? AND lon=? "
+            "AND created>=?", (*cell, self.now - self.ttl)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute(
+            "UPDATE address SET used=? WHERE grid=? AND lat=? AND lon=?",
+            (self.now, *cell))
+        return Address(*json.loads(row[0]))
+
+    def put(self, coords, address):
+        self.db.execute(
+            "INSERT OR REPLACE INTO address VALUES (?,?,?,?,?,?)",
+            (*self.cell(coords), json.dumps(address), self.now, self.now))
+        # Lookups are expensive, keep them even if the run is aborted.
+        self.db.commit()
+
+    def close(self):
+        self.db.execute("DELETE FROM address WHERE created<?",
+                        (self.now - self.ttl,))
+        count, = self.db.execute("SELECT COUNT(*) FROM address").fetchone()
+        if count > self.max_entries:
+            self.db.execute(
+                "DELETE FROM address WHERE rowid IN ("
+                "SELECT rowid FROM address ORDER BY used LIMIT ?)",
+                (count - self.max_entries,))
+        self.db.commit()
+        self.db.close()
+
+    def summary(self):
+        return f"Geocode cache: {self.hits} hits, {self.misses} misses"
+
+
+class Gazetteer:
+    """Offline reverse geocoder using a GeoNames style gazetteer.
+
+    The gazetteer is a tab separated file in the GeoNames format, e.g.
+    cities1000.txt, only the populated places (feature class P) are
+    used. If admin1CodesASCII.txt and countryInfo.txt are next to it
+    they are used for the state and country names.
+
+    The places are bucketed in a grid with cells of cell degrees and
+    written sorted by cell to a binary index the first time, after
+    that the index is memory-mapped. The index is rebuilt if the
+    gazetteer changes. Finding the nearest place is a binary search
+    for each of the surrounding cells.
+    """
+
+    MAGIC = b'PMGAZ001'
+    # magic, count, gazetteer size, gazetteer mtime_ns, cell size
+    HEADER = struct.Struct('<8sQQqd')
+    # How many rings of cells to search around the location.
+    MAX_RINGS = 4
+
+    def __init__(self, source, index_path, cell=0.5):
+        st = os.stat(source)
+        if not self.is_current(index_path, st):
+            self.build(source, index_path, st, cell)
+        with open(index_path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _, count, _, _, self.cell = self.HEADER.unpack_from(self.data)
+        self.cols = round(360 / self.cell)
+        view = memoryview(self.data)
+        pos = self.HEADER.size
+        self.cells = view[pos:pos + 8 * count].cast('q')
+        pos += 8 * count
+        self.coords = view[pos:pos + 16 * count].cast('d')
+        pos += 16 * count
+        self.offsets = view[pos:pos + 4 * (count + 1)].cast('I')
+        self.strings = pos + 4 * (count + 1)
+
+    def is_current(self, index_path, st):
+        try:
+            with open(index_path, 'rb') as f:
+                header = f.read(self.HEADER.size)
+        except FileNotFoundError:
+            return False
+        if len(header) != self.HEADER.size:
+            return False
+        magic, _, size, mtime, _ = self.HEADER.unpack(header)
+        return magic == self.MAGIC and size == st.st_size and \
+            mtime == st.st_mtime_ns
+
+    @staticmethod
+    def read_names(path, key_column, name_column):
+        names = {}
+        if not os.path.exists(path):
+            return names
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) > max(key_column, name_column):
+                    names[fields[key_column]] = fields[name_column]
+        return names
+
+    def cell_of(self, lat, lon, cell):
+        row = int((lat + 90) // cell)
+        col = int((lon + 180) // cell) % round(360 / cell)
+        return row, col
+
+    def build(self, source, index_path, st, cell):
+        print(f"Building gazetteer index from {source}")
+        directory = os.path.dirname(source)
+        states = self.read_names(
+            os.path.join(directory, 'admin1CodesASCII.txt'), 0, 1)
+        countries = self.read_names(
+            os.path.join(directory, 'countryInfo.txt'), 0, 4)
+        cols = round(360 / cell)
+        places = []
+        with open(source, encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 15 or fields[6] != 'P':
+                    continue
+                lat, lon = float(fields[4]), float(fields[5])
+                row, col = self.cell_of(lat, lon, cell)
+                country_code = fields[8]
+                state = states.get(f"{country_code}.{fields[10]}", '')
+                country = countries.get(country_code, country_code)
+                text = '\t'.join((fields[1], state, country,
+                                  country_code.lower()))
+                places.append((row * cols + col, lat, lon, text))
+        places.sort()
+
+        strings = bytearray()
+        offsets = [0]
+        for place in places:
+            strings += place[3].encode('utf-8')
+            offsets.append(len(strings))
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        tmp = f"{index_path}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, len(places), st.st_size,
+                                     st.st_mtime_ns, cell))
+            f.write(struct.pack(f'<{len(places)}q', *(p[0] for p in places)))
+            f.write(struct.pack(f'<{2 * len(places)}d',
+                                *(c for p in places for c in p[1:3])))
+            f.write(struct.pack(f'<{len(offsets)}I', *offsets))
+            f.write(strings)
+        os.replace(tmp, index_path)
+
+    def nearest(self, lat, lon):
+        """Return the index of the place closest to LAT, LON or None."""
+        row, col = self.cell_of(lat, lon, self.cell)
+        scale = math.cos(math.radians(lat))
+        best = None
+        best_dist = None
+        for ring in range(self.MAX_RINGS + 1):
+            for r in range(row - ring, row + ring + 1):
+                for c in range(col - ring, col + ring + 1):
+                    if max(abs(r - row), abs(c - col)) != ring:
+                        continue
+                    key = r * self.cols + c % self.cols
+                    i = bisect.bisect_left(self.cells, key)
+                    while i < len(self.cells) and self.cells[i] == key:
+                        dlat = self.coords[2 * i] - lat
+                        dlon = (self.coords[2 * i + 1] - lon) * scale
+                        dist = dlat * dlat + dlon * dlon
+                        if best_dist is None or dist < best_dist:
+                            best, best_dist = i, dist
+                        i += 1
+            # Every place in the next ring is at least RING cells away
+            # along the latitude or the (scaled) longitude, stop once
+            # the best place found is closer than that.
+            reach = ring * self.cell * min(1.0, scale)
+            if best is not None and best_dist <= reach * reach:
+                break
+        return best
+
+    def lookup(self, coords):
+        """Return the Address of the place closest to COORDS."""
+        i = self.nearest(float(coords[0]), float(coords[1]))
+        if i is None:
+            return Address(None, {}, "No place nearby in the gazetteer")
+        text = self.data[self.strings + self.offsets[i]:
+                         self.strings + self.offsets[i + 1]].decode('utf-8')
+        city, state, country, country_code = text.split('\t')
+        parts = {'city': city, 'state': state, 'country': country,
+                 'country_code': country_code}
+        parts = {k: v for k, v in parts.items() if v}
+        display = ', '.join(parts[k] for k in ('city', 'state', 'country')
+                            if k in parts)
+        return Address(display, parts, None)
+
+
+class MetadataCache:
+    """SQLite backed cache of the metadata extracted from the files.
+
+    Entries are keyed by the identity of the file, i.e. device, inode,
+    size and modification time, so a file that hasn't changed since
+    the last run doesn't need to be opened with GExiv2 again. The
+    context is the default maker and model, which end up in the
+    records when the metadata is missing, and the camera rules from
+    the config, so changing them doesn't return stale entries.
+
+    Once the cache holds more than max_entries the least recently used
+    entries are evicted when it's closed. The hits are marked as used
+    in batches of flush_size.
+    """
+
+    def __init__(self, path, context, max_entries=200000, rebuild=False,
+                 flush_size=10000):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.context = context
+        self.max_entries = max_entries
+        self.flush_size = flush_size
+        self.hits = 0
+        self.misses = 0
+        self.now = int(time.time())
+        self.used = []
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, "
+            "context TEXT, make TEXT, model TEXT, date TEXT, gps TEXT, "
+            "used INTEGER, "
+            "PRIMARY KEY (dev, ino, size, mtime_ns, context))")
+        if rebuild:
+            self.db.execute("DELETE FROM metadata")
+
+    @staticmethod
+    def identity(path, st=None):
+        if st is None:
+            st = os.stat(path)
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def get(self, ident):
+        row = self.db.execute(
+            "SELECT make, model, date, gps FROM metadata WHERE "
+            "dev=? AND ino=? AND size=? AND mtime_ns=? AND context=?",
+            (*ident, self.context)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used.append((self.now, *ident, self.context))
+        if len(self.used) >= self.flush_size:
+            self.flush()
+        make, model, date, gps = row
+        return FileMeta(make, model, date, json.loads(gps))
+
+    def put(self, ident, meta):
+        self.db.execute(
+            "INSERT OR REPLACE INTO metadata VALUES (?,?,?,?,?,?,?,?,?,?)",
+            (*ident, self.context, meta.make, meta.model, meta.date,
+             json.dumps(meta.gps), self.now))
+
+    def flush(self):
+        self.db.executemany(
+            "UPDATE metadata SET used=? WHERE "
+            "dev=? AND ino=? AND size=? AND mtime_ns=? AND context=?",
+            self.used)
+        self.used = []
+
+    def commit(self):
+        self.flush()
+        count, = self.db.execute("SELECT COUNT(*) FROM metadata").fetchone()
+        if count > self.max_entries:
+            self.db.execute(
+                "DELETE FROM metadata WHERE rowid IN ("
+                "SELECT rowid FROM metadata ORDER BY used LIMIT ?)",
+                (count - self.max_entries,))
+        self.db.commit()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def summary(self):
+        return f"Metadata cache: {self.hits} hits, {self.misses} misses"
+
+
+# Exif extractors for the worker processes, set up once per worker by
+# init_worker.
+_worker_exif = {}
+
+
+def init_worker(default_make, default_model, exif_reader='gexiv2',
+                filters=(None, None)):
+    _worker_exif['img'] = ExifImg(default_make, default_model, *filters)
+    _worker_exif['mov'] = ExifMov(default_make, default_model, *filters)
+    _worker_exif['fast'] = exif_reader == 'fast'
+
+
+def extract_worker(job):
+    path, kind = job
+    return read_metadata(path, _worker_exif[kind], _worker_exif['fast'])
+
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+class Profiler:
+    """Count and time the stages of an import.
+
+    Each stage records how long every call took, in an array of
+    doubles, and optionally the number of bytes it handled. A disabled
+    profiler records nothing.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.times = defaultdict(lambda: array.array('d'))
+        self.bytes = defaultdict(int)
+        self.start = time.perf_counter()
+
+    def record(self, name, elapsed, size=0):
+        with self.lock:
+            self.times[name].append(elapsed)
+            self.bytes[name] += size
+
+    def stage(self, name):
+        """Context manager timing a call of stage NAME."""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._stage(name)
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def timed(self, name, iterable):
+        """Yield from ITERABLE, timing each item as a call of NAME."""
+        if not self.enabled:
+            yield from iterable
+            return
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.record(name, time.perf_counter() - start)
+            yield item
+
+    def report(self):
+        stages = {}
+        for name, times in self.times.items():
+            times = sorted(times)
+            n = len(times)
+            stages[name] = {
+                'count': n,
+                'total': sum(times),
+                'mean': sum(times) / n,
+                'p50': times[int(0.5 * (n - 1))],
+                'p90': times[int(0.9 * (n - 1))],
+                'p99': times[int(0.99 * (n - 1))],
+                'max': times[-1],
+                'bytes': self.bytes[name],
+            }
+        return {'elapsed': time.perf_counter() - self.start,
+                'stages': stages}
+
+    def summary(self):
+        report = self.report()
+        lines = [f"{'stage':<14}{'count':>8}{'total s':>10}{'p50 ms':>9}"
+                 f"{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}  throughput"]
+        for name, s in sorted(report['stages'].items(),
+                              key=lambda item: -item[1]['total']):
+            rate = ''
+            if s['bytes'] and s['total']:
+                rate = f"{format_size(s['bytes'] / s['total'])}/s"
+            lines.append(
+                f"{name:<14}{s['count']:>8}{s['total']:>10.3f}"
+                f"{s['p50'] * 1e3:>9.2f}{s['p90'] * 1e3:>9.2f}"
+                f"{s['p99'] * 1e3:>9.2f}{s['max'] * 1e3:>9.2f}  {rate}")
+        lines.append(f"Total {report['elapsed']:.3f} s")
+        return '\n'.join(lines)
+
+
+# ioctl request to share the data blocks of a file (reflink), see
+# ioctl_ficlone(2).
+FICLONE = 0x40049409
+FS_IOC_FIEMAP = 0xC020660B
+# struct fiemap with room for one struct fiemap_extent
+FIEMAP_FORMAT = '=QQIIII' + 'QQQQQIIII'
+
+
+# Where PATH is on the disk, for reading files in the order they are
+# stored. Uses the physical offset of the first extent if the file
+# system can tell (FIEMAP), otherwise the inode number which on most
+# file systems, including FAT, follows the order the files were
+# written.
+def disk_position(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return (2, 0)
+    try:
+        buf = bytearray(struct.calcsize(FIEMAP_FORMAT))
+        struct.pack_into('=QQIII', buf, 0, 0, 2**64 - 1, 0, 0, 1)
+        try:
+            fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+            fields = struct.unpack(FIEMAP_FORMAT, buf)
+            # fm_mapped_extents, fe_physical. Data not written to
+            # the disk yet has no physical offset.
+            if fields[3] and fields[7]:
+                return (0, fields[7])
+        except OSError:
+            pass
+        return (1, os.fstat(fd).st_ino)
+    finally:
+        os.close(fd)
+
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+
+class Inotify:
+    """Watch directories for new files with inotify(7).
+
+    read returns the (wd, mask, name) of the pending events.
+    """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f"inotify_init1: {os.strerror(e)}")
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def read(self):
+        events = []
+        buf = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = struct.unpack_from('iIII', buf, offset)
+            offset += 16
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class CopyEngine:
+    """Copy or move files to the destination using a pool of threads.
+
+    At most jobs transfers run at the same time and submit blocks once
+    queue_size transfers are waiting. A file that already exists at
+    the destination is left untouched, the source is kept and counted
+    as skipped. Moves within the same file system are done with a
+    rename, copies use the cheapest method the file systems support:
+    reflink, copy_file_range, sendfile and last a plain read/write
+    loop.
+
+    With verify the data is hashed while it's copied and the
+    destination is read back from the disk and compared before the
+    source is removed.
+
+    With device_jobs at most that many transfers from the same source
+    device run at the same time, the rest wait in line for that
+    device in the order they were submitted.
+
+    With a reorder window the transfers are collected until there are
+    that many, or no new ones have come for linger seconds, and then
+    started one destination directory at a time, in the order the
+    sources are stored on the disk. They are started from a thread of
+    its own, submit only blocks while the window is full.
+
+    With an ArchiveWriter each transferred file is also added to the
+    archive, read from the destination while it's still in the page
+    cache so the source is only read once.
+    """
+
+    def __init__(self, jobs=4, queue_size=None, verbose=False, journal=None,
+                 verify=False, device_jobs=None, reorder=256, linger=1.0,
+                 profiler=None, archive=None):
+        self.verbose = verbose
+        self.archive = archive
+        self.profiler = profiler or Profiler(enabled=False)
+        self.journal = journal
+        self.verify = verify
+        self.device_jobs = device_jobs
+        self.reorder = reorder
+        self.linger = linger
+        self.window = []
+        self.pending = threading.Condition()
+        self.closing = False
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.slots = threading.BoundedSemaphore(queue_size or jobs * 4)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        # device -> transfers waiting and number running
+        self.lanes = defaultdict(deque)
+        self.active = defaultdict(int)
+        self.created = set()
+        self.errors = []
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.start = time.monotonic()
+        if reorder:
+            self.dispatcher = threading.Thread(target=self.run_dispatcher,
+                                               daemon=True)
+            self.dispatcher.start()
+
+    def submit(self, src, dst, move=False, device=None):
+        if not self.reorder:
+            self.dispatch(src, dst, move, device)
+            return
+        with self.pending:
+            self.pending.wait_for(lambda: len(self.window) < self.reorder)
+            self.window.append((src, dst, move, device))
+            self.pending.notify_all()
+
+    # Take the transfers in the window once it's full, or no new ones
+    # have come for linger seconds, and start them. Runs in a thread of
+    # its own until finish.
+    def run_dispatcher(self):
+        while True:
+            with self.pending:
+                while not self.closing and len(self.window) < self.reorder:
+                    count = len(self.window)
+                    self.pending.wait(self.linger)
+                    if self.window and len(self.window) == count:
+                        break
+                if not self.window:
+                    return
+                batch, self.window = self.window, []
+                self.pending.notify_all()
+            try:
+                for job in self.order(batch):
+                    self.dispatch(*job)
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(e)
+
+    # The transfers in BATCH grouped by destination directory. The
+    # directories are taken in the order of their first file on the
+    # disk and the files in each in the order on the disk.
+    @staticmethod
+    def order(batch):
+        dirs = defaultdict(list)
+        for job in batch:
+            dirs[os.path.dirname(job[1])].append(
+                (disk_position(job[0]), job[0], job))
+        for files in sorted((sorted(files) for files in dirs.values()),
+                            key=lambda files: files[0][:2]):
+            for _, _, job in files:
+                yield job
+
+    def dispatch(self, src, dst, move, device):
+        self.slots.acquire()
+        if self.device_jobs is None:
+            device = None
+        if device is not None:
+            with self.lock:
+                if self.active[device] >= self.device_jobs:
+                    self.lanes[device].append((src, dst, move))
+                    return
+                self.active[device] += 1
+        self.start_transfer(src, dst, move, device)
+
+    def start_transfer(self, src, dst, move, device):
+        future = self.executor.submit(self.transfer, src, dst, move)
+        future.add_done_callback(lambda f: self.done(f, device))
+
+    def done(self, future, device=None):
+        self.slots.release()
+        job = None
+        with self.lock:
+            if future.exception() is not None:
+                self.errors.append(future.exception())
+            if device is not None:
+                if self.lanes[device]:
+                    job = self.lanes[device].popleft()
+                else:
+                    self.active[device] -= 1
+                    self.idle.notify_all()
+        if job is not None:
+            self.start_transfer(*job, device)
+
+    def finish(self):
+        """Wait for all transfers, raise the first error if any failed."""
+        if self.reorder:
+            with self.pending:
+                self.closing = True
+                self.pending.notify_all()
+            self.dispatcher.join()
+        with self.idle:
+            self.idle.wait_for(lambda: not any(self.active.values()))
+        self.executor.shutdown(wait=True)
+        if self.errors:
+            raise self.errors[0]
+
+    # checks if a directory exists, if not it creates it. Only done
+    # once per directory.
+    def ensure_dir(self, f):
+        d = os.path.dirname(f)
+        with self.lock:
+            if d in self.created:
+                return
+            # Create it while holding the lock, other threads must not
+            # write to it before it exists.
+            with self.profiler.stage('ensure_dir'):
+                try:
+                    os.makedirs(d)
+                    print(f"Created path: {d}")
+                except FileExistsError:
+                    pass
+            self.created.add(d)
+
+    def transfer(self, src, dst, move):
+        start = time.perf_counter()
+        self.ensure_dir(dst)
+        if move:
+            size = self.rename(src, dst)
+        if not move or size is None:
+            size = self.copy(src, dst)
+            if size is not None and move:
+                if self.journal is not None:
+                    self.journal.copied_file(src, dst)
+                os.remove(src)
+        if size is None:
+            # Another file took the name after it was picked, leave
+            # the source for the next import.
+            print(f"[Warning] Not copying {src}, {dst} already exists")
+            with self.lock:
+                self.skipped += 1
+            return
+        if self.journal is not None:
+            self.journal.finished(src)
+        if self.archive is not None:
+            self.archive.add(dst)
+        if self.profiler.enabled:
+            self.profiler.record('transfer', time.perf_counter() - start,
+                                 size)
+        if self.verbose:
+            print(" -Moved to", dst)
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+
+    # Rename SRC to DST if they are on the same file system and DST
+    # doesn't exist. Returns the size of the file, or None if it
+    # couldn't be renamed. Done with a hard link and unlink as
+    # os.rename would replace a file another thread just put at DST.
+    def rename(self, src, dst):
+        st = os.stat(src)
+        if st.st_dev != os.stat(os.path.dirname(dst)).st_dev:
+            return None
+        try:
+            os.link(src, dst)
+        except FileExistsError:
+            return None
+        except OSError as e:
+            # Different file systems, or one without hard links.
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.ENOTSUP):
+                raise
+            return None
+        os.unlink(src)
+        return st.st_size
+
+    # Copy SRC to DST including the metadata. Returns the number of
+    # bytes copied, or None if DST already exists. The data is copied
+    # to a hidden temporary file next to DST that is put in place once
+    # complete, so an interrupted copy never leaves a truncated DST
+    # that a later run would take as already imported.
+    def copy(self, src, dst):
+        if os.path.exists(dst):
+            return None
+        directory, name = os.path.split(dst)
+        with open(src, 'rb') as fsrc:
+            size = os.fstat(fsrc.fileno()).st_size
+            fd, tmp = tempfile.mkstemp(prefix=f'.{name}.', suffix='.part',
+                                       dir=directory)
+            try:
+                with open(fd, 'wb') as fdst:
+                    if self.verify:
+                        self.verified_copy(fsrc.fileno(), fdst.fileno(), tmp)
+                    else:
+                        self.copy_data(fsrc.fileno(), fdst.fileno(), size)
+                shutil.copystat(src, tmp)
+                placed = self.place(tmp, dst)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        return size if placed else None
+
+    # Move the finished copy TMP to DST unless DST exists, returns
+    # whether it was moved.
+    def place(self, tmp, dst):
+        try:
+            os.link(tmp, dst)
+            return True
+        except FileExistsError:
+            return False
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.ENOTSUP):
+                raise
+        # No hard links on this file system, at least keep the threads
+        # from replacing each other's files.
+        with self.lock:
+            if os.path.exists(dst):
+                return False
+            os.rename(tmp, dst)
+            return True
+
+    @staticmethod
+    def copy_data(src_fd, dst_fd, size):
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return
+        except OSError:
+            pass
+
+        offset = 0
+        try:
+            while offset < size:
+                n = os.copy_file_range(src_fd, dst_fd, size - offset,
+                                       offset, offset)
+                if n == 0:
+                    break
+                offset += n
+            return
+        except OSError:
+            pass
+
+        try:
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            while offset < size:
+                n = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                if n == 0:
+                    break
+                offset += n
+            return
+        except OSError:
+            pass
+
+        os.lseek(src_fd, offset, os.SEEK_SET)
+        os.lseek(dst_fd, offset, os.SEEK_SET)
+        while True:
+            buf = os.read(src_fd, 1024 * 1024)
+            if not buf:
+                break
+            os.write(dst_fd, buf)
+
+    # Copy the data in one pass while hashing it, flush it to the disk
+    # and read it back to check that it made it there intact. The
+    # source is only read once.
+    @staticmethod
+    def verified_copy(src_fd, dst_fd, dst):
+        h = hashlib.blake2b()
+        while True:
+            buf = os.read(src_fd, 1024 * 1024)
+            if not buf:
+                break
+            h.update(buf)
+            view = memoryview(buf)
+            while view:
+                view = view[os.write(dst_fd, view):]
+        os.fsync(dst_fd)
+        # Drop the pages we just wrote from the page cache, otherwise
+        # the data is read back from memory and not from the disk.
+        os.posix_fadvise(dst_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        if hash_file(dst) != h.hexdigest():
+            raise RuntimeError(
+                f"[Error] {dst} doesn't match the source after copying it")
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        summary = (f"Transferred {self.files} files, "
+                   f"{format_size(self.bytes)} in {elapsed:.1f} s "
+                   f"({format_size(self.bytes / elapsed)}/s)")
+        if self.skipped:
+            summary += (f", skipped {self.skipped} files whose name was "
+                        "taken")
+        return summary
+
+
+class ArchiveWriter:
+    """Write the imported files to a tar or zip archive as they come.
+
+    The format is picked from the extension of PATH: .zip, .tar.zst
+    (needs the zstandard module) or else tar. The members are named by
+    their path relative to ROOT, so the archive has the same layout as
+    the destination. A thread of its own writes the files in the order
+    they are added, in one pass with large sequential writes. At most
+    queue_size files wait to be written, add blocks after that.
+
+    The archive is written next to PATH and renamed once closed, an
+    interrupted import doesn't leave a truncated archive behind.
+    """
+
+    def __init__(self, path, root, queue_size=64, bufsize=4 * 1024 * 1024):
+        self.path = path
+        self.root = root
+        self.bufsize = bufsize
+        self.files = 0
+        self.bytes = 0
+        self.error = None
+        self.tar = self.zip = self.compressor = None
+        self.file = open(f'{path}.part', 'wb', buffering=bufsize)
+        if path.endswith('.zip'):
+            import zipfile
+            self.zip = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_STORED)
+        else:
+            import tarfile
+            fileobj = self.file
+            if path.endswith(('.tar.zst', '.tzst')):
+                try:
+                    import zstandard
+                except ImportError:
+                    self.file.close()
+                    os.remove(f'{path}.part')
+                    raise RuntimeError("[Error] Writing a .tar.zst needs "
+                                       "the zstandard module.")
+                fileobj = self.compressor = zstandard.ZstdCompressor(
+                    threads=-1).stream_writer(self.file, closefd=False)
+            self.tar = tarfile.open(fileobj=fileobj, mode='w|',
+                                    bufsize=bufsize, copybufsize=bufsize,
+                                    format=tarfile.PAX_FORMAT)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, path, dst=None):
+        """Add the file at PATH as DST, which defaults to PATH."""
+        if self.error is not None:
+            raise self.error
+        self.queue.put((path, os.path.relpath(dst or path, self.root)))
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            # Keep taking the files after an error so add doesn't
+            # block, the error is raised by add and close.
+            if self.error is None:
+                try:
+                    self.write_member(*job)
+                except BaseException as e:
+                    self.error = e
+
+    def write_member(self, path, arcname):
+        with open(path, 'rb') as f:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            size = os.fstat(f.fileno()).st_size
+            if self.tar is not None:
+                self.tar.addfile(
+                    self.tar.gettarinfo(arcname=arcname, fileobj=f), f)
+            else:
+                import zipfile
+                info = zipfile.ZipInfo.from_file(path, arcname)
+                with self.zip.open(info, 'w') as dst:
+                    shutil.copyfileobj(f, dst, self.bufsize)
+        self.files += 1
+        self.bytes += size
+
+    def close(self):
+        """Finish the archive, raise the error if a file failed."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is None:
+            (self.tar or self.zip).close()
+            if self.compressor is not None:
+                self.compressor.close()
+        self.file.close()
+        if self.error is not None:
+            os.remove(f'{self.path}.part')
+            raise self.error
+        os.replace(f'{self.path}.part', self.path)
+
+    def summary(self):
+        return (f"Archived {self.files} files, {format_size(self.bytes)} "
+                f"to {self.path}")
+
+
+class SpillMap:
+    """Mapping from strings to strings or None that can spill to disk.
+
+    The entries are kept in a dict until there are more than limit of
+    them, then they are moved to a private temporary SQLite database
+    that is removed when closed. This keeps the memory flat for the
+    things that grow with the number of files, e.g. the files already
+    imported. Used as a set by adding keys without values. A limit of
+    None keeps everything in memory.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.dict = {}
+        self.db = None
+
+    def spill(self):
+        self.db = sqlite3.connect('')
+        self.db.execute(
+            "CREATE TABLE map (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.executemany("INSERT INTO map VALUES (?, ?)",
+                            self.dict.items())
+        self.dict = None
+
+    def __setitem__(self, key, value):
+        if self.db is not None:
+            self.db.execute("INSERT OR REPLACE INTO map VALUES (?, ?)",
+                            (key, value))
+            return
+        self.dict[key] = value
+        if self.limit is not None and len(self.dict) > self.limit:
+            self.spill()
+
+    def __getitem__(self, key):
+        if self.db is None:
+            return self.dict[key]
+        row = self.db.execute("SELECT value FROM map WHERE key=?",
+                              (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def __contains__(self, key):
+        if self.db is None:
+            return key in self.dict
+        return self.db.execute("SELECT 1 FROM map WHERE key=?",
+                               (key,)).fetchone() is not None
+
+    def __len__(self):
+        if self.db is None:
+            return len(self.dict)
+        return self.db.execute("SELECT COUNT(*) FROM map").fetchone()[0]
+
+    def add(self, key):
+        self[key] = None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        if self.db is None:
+            return list(self.dict.items())
+        return self.db.execute("SELECT key, value FROM map")
+
+    def update(self, items):
+        for key, value in items:
+            self[key] = value
+
+    # Remove the keys starting with PREFIX.
+    def discard_prefix(self, prefix):
+        if self.db is None:
+            self.dict = {k: v for k, v in self.dict.items()
+                         if not k.startswith(prefix)}
+        else:
+            self.db.execute("DELETE FROM map WHERE substr(key, 1, ?) = ?",
+                            (len(prefix), prefix))
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+
+class ImportJournal:
+    """Write-ahead journal of an import.
+
+    Records the event (writepath) or ignore decision for each key
+    before any file using it is copied, and each file once it has been
+    transferred. With --mv a file is recorded as copied before the
+    source is removed, so a removal interrupted by a crash can be
+    finished when resuming.
+
+    Resuming loads the journal so decided keys aren't prompted for
+    again and finished files are skipped. The journal is removed once
+    the import completes. The keys and files loaded spill to disk past
+    limit entries, see SpillMap.
+    """
+
+    def __init__(self, path, resume=False, limit=None):
+        self.path = path
+        self.writepath = SpillMap(limit)
+        self.ignore = SpillMap(limit)
+        self.done = SpillMap(limit)
+        # src -> dst for files copied but not yet removed
+        self.copied = {}
+        if resume and os.path.exists(path):
+            self.load()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.file = open(path, 'a' if resume else 'w')
+
+    def load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Partially written entry from a crash.
+                    break
+                op = entry['op']
+                if op == 'event':
+                    self.writepath[entry['key']] = entry['path']
+                elif op == 'ignore':
+                    self.ignore.add(entry['key'])
+                elif op == 'copied':
+                    self.copied[entry['src']] = entry['dst']
+                elif op == 'done':
+                    self.done.add(entry['src'])
+                    self.copied.pop(entry['src'], None)
+
+    def write(self, entry, sync=False):
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+
+    def event(self, key, path):
+        self.write({'op': 'event', 'key': key, 'path': path}, sync=True)
+
+    def ignored(self, key):
+        self.write({'op': 'ignore', 'key': key}, sync=True)
+
+    def copied_file(self, src, dst):
+        self.write({'op': 'copied', 'src': src, 'dst': dst}, sync=True)
+
+    def finished(self, src):
+        self.write({'op': 'done', 'src': src})
+
+    def close(self, complete=False):
+        self.file.close()
+        for spilled in (self.writepath, self.ignore, self.done):
+            spilled.close()
+        if complete:
+            os.remove(self.path)
+
+
+def hash_file(path):
+    h = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(1024 * 1024)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+
+def same_content(path, st, others):
+    """Return whether the file at PATH, with stat ST, is the same as
+    another file.
+
+    OTHERS are the paths the other file can be at, the first that
+    exists is compared, e.g. the source and destination of a file
+    being moved.
+    """
+    for other in others:
+        try:
+            if os.stat(other).st_size != st.st_size:
+                return False
+            return filecmp.cmp(path, other, shallow=False)
+        except FileNotFoundError:
+            pass
+    return False
+
+
+class LibraryIndex:
+    """Content index of the files in the destination library.
+
+    Stores the size and mtime of every file under the roots in a
+    SQLite database, along with the subdirectories of each directory.
+    Directories whose mtime hasn't changed since the last refresh are
+    only stat'ed, not listed again. Hidden files are skipped. Files
+    are only hashed (BLAKE2) when another file of the same size is
+    looked up, and the hash is kept until the file changes.
+    """
+
+    def __init__(self, path, roots):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.roots = roots
+        # Replaced by listings, which also has the subdirectories.
+        self.db.execute("DROP TABLE IF EXISTS dirs")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS listings ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER, subdirs TEXT)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, dir TEXT, size INTEGER, "
+            "mtime_ns INTEGER, hash TEXT)")
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS files_size ON files (size)")
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS files_dir ON files (dir)")
+        # Destinations handed out in this run -> their source, the
+        # files may still be waiting in the copy engine.
+        self.pending = {}
+        self.refresh()
+
+    def refresh(self):
+        known = {path: (mtime_ns, subdirs) for path, mtime_ns, subdirs in
+                 self.db.execute(
+                     "SELECT path, mtime_ns, subdirs FROM listings")}
+        seen = set()
+        stack = list(self.roots)
+        while stack:
+            d = stack.pop()
+            try:
+                mtime = os.stat(d).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            seen.add(d)
+            if d in known and known[d][0] == mtime:
+                # Nothing was added or removed in it.
+                stack.extend(json.loads(known[d][1]))
+                continue
+            subdirs = []
+            files = {}
+            try:
+                it = os.scandir(d)
+            except FileNotFoundError:
+                continue
+            with it:
+                for e in it:
+                    if e.name.startswith('.'):
+                        continue
+                    if e.is_dir(follow_symlinks=False):
+                        subdirs.append(e.path)
+                    elif e.is_file(follow_symlinks=False):
+                        st = e.stat(follow_symlinks=False)
+                        files[e.path] = (st.st_size, st.st_mtime_ns)
+            stack.extend(subdirs)
+            self.sync_dir(d, mtime, files, subdirs)
+        for d in set(known) - seen:
+            self.db.execute("DELETE FROM listings WHERE path=?", (d,))
+            self.db.execute("DELETE FROM files WHERE dir=?", (d,))
+
+    def sync_dir(self, d, mtime, files, subdirs):
+        old = {path: (size, mtime_ns) for path, size, mtime_ns in
+               self.db.execute(
+                   "SELECT path, size, mtime_ns FROM files WHERE dir=?",
+                   (d,))}
+        for path in old.keys() - files.keys():
+            self.db.execute("DELETE FROM files WHERE path=?", (path,))
+        for path, (size, mtime_ns) in files.items():
+            if old.get(path) != (size, mtime_ns):
+                self.db.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?,?,?,?,NULL)",
+                    (path, d, size, mtime_ns))
+        self.db.execute("INSERT OR REPLACE INTO listings VALUES (?,?,?)",
+                        (d, mtime, json.dumps(subdirs)))
+
+    def hash_of(self, path, size, mtime_ns, stored):
+        """Return the hash of PATH, using STORED if it's unchanged."""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            if path not in self.pending:
+                self.db.execute("DELETE FROM files WHERE path=?", (path,))
+                return None
+            # Not copied yet, it has the content of its source.
+            if stored is None:
+                stored = hash_file(self.pending[path])
+                self.db.execute("UPDATE files SET hash=? WHERE path=?",
+                                (stored, path))
+            return stored
+        if stored is not None and \
+           (st.st_size, st.st_mtime_ns) == (size, mtime_ns):
+            return stored
+        digest = hash_file(path)
+        self.db.execute(
+            "UPDATE files SET size=?, mtime_ns=?, hash=? WHERE path=?",
+            (st.st_size, st.st_mtime_ns, digest, path))
+        return digest
+
+    def find(self, src, size):
+        """Return a file in the library with the same content as SRC.
+
+        Returns (path, hash of SRC) or (None, hash of SRC), the hash
+        is None if there is no file of the same size.
+        """
+        candidates = self.db.execute(
+            "SELECT path, size, mtime_ns, hash FROM files WHERE size=?",
+            (size,)).fetchall()
+        if not candidates:
+            return None, None
+        digest = hash_file(src)
+        for path, size, mtime_ns, stored in candidates:
+            if self.hash_of(path, size, mtime_ns, stored) == digest:
+                return path, digest
+        return None, digest
+
+    def contains(self, path):
+        return path in self.pending or \
+            self.db.execute("SELECT 1 FROM files WHERE path=?",
+                            (path,)).fetchone() is not None
+
+    # Add PATH, if SRC is given it's where the file is copied from.
+    def add(self, path, size, mtime_ns, digest=None, src=None):
+        if src is not None:
+            self.pending[path] = src
+        self.db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?,?,?,?,?)",
+            (path, os.path.dirname(path), size, mtime_ns, digest))
+
+    def close(self, commit=True):
+        if commit:
+            self.db.commit()
+        self.db.close()
+
+
+class EventIndex:
+    """Index of the event directories at the destination.
+
+    The destination is laid out as [root]/[make]/[model]/[year]/[event]
+    where event starts with the date. All the year directories under
+    the roots are scanned once and their events are grouped by the
+    date, so finding the events for a date is a dict lookup instead of
+    a directory listing.
+
+    If cache_path is set the index is saved there and the next scan
+    only lists the year directories whose mtime have changed.
+    """
+
+    def __init__(self, roots, cache_path=None):
+        self.cache_path = cache_path
+        # year dir -> date -> event names
+        self.events = {}
+        # year dir -> (mtime_ns, event names)
+        self.years = {}
+        self.dirty = set()
+        # (year dir, event) created during the run
+        self.created = set()
+        saved = {}
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path) as f:
+                saved = json.load(f)
+        for root in roots:
+            self.scan(root, saved)
+
+    @staticmethod
+    def subdirs(path):
+        try:
+            with os.scandir(path) as it:
+                return [e for e in it if e.is_dir()]
+        except FileNotFoundError:
+            return []
+
+    def scan(self, root, saved):
+        for make in self.subdirs(root):
+            for model in self.subdirs(make.path):
+                for year in self.subdirs(model.path):
+                    mtime = year.stat().st_mtime_ns
+                    entry = saved.get(year.path)
+                    if entry is not None and entry[0] == mtime:
+                        names = entry[1]
+                    else:
+                        names = [e.name for e in self.subdirs(year.path)]
+                    self.years[year.path] = (mtime, names)
+                    for name in names:
+                        self.insert(year.path, name)
+
+    def insert(self, year_path, name):
+        dates = self.events.setdefault(year_path, {})
+        dates.setdefault(name[:10], []).append(name)
+
+    def find(self, year_path, date):
+        """Return the events in YEAR_PATH starting with DATE."""
+        events = self.events.get(year_path, {}).get(date[:10], [])
+        return sorted(e for e in events if e.startswith(date))
+
+    def add(self, event_path):
+        """Add EVENT_PATH created during the run to the index.
+
+        The event is only returned by find after the index has been
+        saved, so keys found later in the same run are not prompted
+        about events picmover just created.
+        """
+        year_path, name = os.path.split(event_path.rstrip('/'))
+        if name in self.events.get(year_path, {}).get(name[:10], []):
+            return
+        self.created.add((year_path, name))
+
+    def save(self):
+        for year_path, name in self.created:
+            if name in self.events.get(year_path, {}).get(name[:10], []):
+                continue
+            self.insert(year_path, name)
+            mtime, names = self.years.get(year_path, (None, []))
+            self.years[year_path] = (mtime, names + [name])
+            self.dirty.add(year_path)
+        self.created.clear()
+        if self.cache_path is None:
+            return
+        for year_path in self.dirty:
+            mtime, names = self.years[year_path]
+            try:
+                mtime = os.stat(year_path).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            self.years[year_path] = (mtime, names)
+        self.dirty.clear()
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        with open(self.cache_path, 'w') as f:
+            json.dump(self.years, f)
+
+
 class PicMover:
 
     def __init__(
@@ -239,7 +2403,24 @@ class PicMover:
             ignore_all=False,
             match=None,
             camera_maker="Unknown maker",
-            camera_model="Unknown model"):
+            camera_model="Unknown model",
+            jobs=1,
+            copy_jobs=4,
+            device_jobs=1,
+            exif_reader='gexiv2',
+            geocoder='nominatim',
+            resume=False,
+            dedup=False,
+            verify=False,
+            plan=None,
+            rules=None,
+            watch=False,
+            reorder=True,
+            profile=None,
+            archive=None,
+            archive_only=False,
+            use_cache=True,
+            rebuild_cache=False):
         # Convert ~/ to relative path if needed.
         expanded_path = os.path.expanduser(path)
         # Init variables
@@ -247,13 +2428,34 @@ class PicMover:
         video_path = "Video"
         root = os.path.expanduser("~")
         check_if_mounted = False
+        self.cache_dir = cache_dir()
+        metadata_cache_size = 200000
+        # (pattern, replacement) from MakeRule and ModelRule
+        camera_rules = {'MakeRule': [], 'ModelRule': []}
+        # Keys, and files in the journal, past this many are moved to
+        # disk.
+        self.spill = 100000
+        self.geocode_url = "https://nominatim.openstreetmap.org/reverse"
+        self.geocode_grid = 0.001
+        self.geocode_ttl = 90
+        self.geocode_cache_size = 100000
+        self.gazetteer_path = None
+        self.gazetteer = None
+        self.geocode_rate = 1.0
+        self.geocode_workers = 2
+        self.geocode_stage = None
         self.camera_maker = camera_maker
         self.camera_model = camera_model
 
         is_camera_maker_unset = camera_maker == "Unknown maker"
         is_camera_model_unset = camera_model == "Unknown model"
 
-        self.IMAGE_POOL_PATH = pool
+        self.IMAGE_POOL_PATHS = [pool] if isinstance(pool, str) else \
+            list(pool)
+        source_path_set = False
+        # Paths that must be mounted before importing, when watching
+        # they are waited for instead.
+        self.mounts = []
         # Read settings
         f = open(expanded_path, "r")
         for line in f:
@@ -278,13 +2480,55 @@ class PicMover:
                 if verbose:
                     print("Video directory is set to:", data[1])
             elif data[0] == "SourcePath":
-                self.IMAGE_POOL_PATH = data[1]
-                if not os.path.ismount(data[1]):
+                # Each SourcePath adds a pool, replacing the ones from
+                # the command line.
+                if not source_path_set:
+                    self.IMAGE_POOL_PATHS = []
+                    source_path_set = True
+                self.IMAGE_POOL_PATHS.append(data[1])
+                self.mounts.append(data[1])
+                if not watch and not os.path.ismount(data[1]):
                     raise RuntimeError(
                         "[Error] Root path is not mounted! Abort!"
                     )
                 if verbose:
                     print("Source path is set to:", data[1])
+            elif data[0] in camera_rules:
+                # Keyword PATTERN -> REPLACEMENT, the pattern can have
+                # spaces.
+                pattern, arrow, replacement = \
+                    line.split(None, 1)[1].strip().partition(' -> ')
+                if not arrow:
+                    raise RuntimeError(
+                        f"[Error] {data[0]} needs PATTERN -> NAME: "
+                        f"{line.strip()}")
+                camera_rules[data[0]].append((pattern, replacement))
+            elif data[0] == "CacheDir":
+                self.cache_dir = os.path.expanduser(data[1])
+                if verbose:
+                    print("Cache directory is set to:", data[1])
+            elif data[0] == "MetadataCacheSize":
+                metadata_cache_size = int(data[1])
+            elif data[0] == "InMemoryEntries":
+                self.spill = int(data[1])
+            elif data[0] == "GeocodeURL":
+                self.geocode_url = data[1]
+                if verbose:
+                    print("Geocode URL is set to:", data[1])
+            elif data[0] == "GeocodeGrid":
+                self.geocode_grid = float(data[1])
+            elif data[0] == "GeocodeCacheTTL":
+                self.geocode_ttl = int(data[1])
+            elif data[0] == "GeocodeCacheSize":
+                self.geocode_cache_size = int(data[1])
+            elif data[0] == "GeocodeRate":
+                self.geocode_rate = float(data[1])
+            elif data[0] == "GeocodeWorkers":
+                self.geocode_workers = int(data[1])
+            elif data[0] == "Gazetteer":
+                self.gazetteer_path = os.path.expanduser(data[1])
+                if verbose:
+                    print("Gazetteer is set to:", data[1])
             elif data[0] == "CheckIfMounted":
                 check_if_mounted = yesNo(data[1])
                 if verbose:
@@ -293,8 +2537,12 @@ class PicMover:
             print("Default camera maker is", self.camera_maker)
             print("Default camera model is", self.camera_model)
 
-        # if check_if_mounted and not os.path.ismount(root):
-        if check_if_mounted and not os.path.ismount(root):
+        self.filters = (
+            CameraFilter(camera_rules['MakeRule'] + MAKE_RULES),
+            CameraFilter(camera_rules['ModelRule'] + MODEL_RULES))
+        if check_if_mounted:
+            self.mounts.append(root)
+        if check_if_mounted and not watch and not os.path.ismount(root):
             raise RuntimeError("[Error] Root path is not mounted! Abort!")
 
         # Only add '/' if the *_path doesn't start with '/'
@@ -305,33 +2553,80 @@ class PicMover:
         self.subdir_raw = 'raw/'
         self.subdir_jpg = 'JPEG/'
         self.subdir_mov = 'mov/'
+        # filetype -> (exif kind, target path, subdir, type name)
+        self.filetypes = {
+            'RAW': ('img', self.TARGET_IMAGE_PATH, self.subdir_raw,
+                    "raw image"),
+            'JPG': ('img', self.TARGET_IMAGE_PATH, self.subdir_jpg,
+                    "jpg image"),
+            'MOV': ('mov', self.TARGET_VIDEO_PATH, self.subdir_mov,
+                    "movie"),
+        }
         self.date_only = date_only
         self.ignore_all = ignore_all
-        self.dry_run = dry_run
+        # A plan is a dry run that writes down what it would do.
+        self.plan_path = plan
+        self.plan = None
+        self.interactive = plan is None
+        self.rules = load_rules(rules) if rules else []
+        if archive_only and archive is None:
+            raise RuntimeError("[Error] --archive-only needs --archive!")
+        if archive_only and move:
+            raise RuntimeError(
+                "[Error] --archive-only can't be used with --mv!")
+        # The archive is written unless it's a dry run, with
+        # archive_only nothing else is.
+        self.archive_path = archive if not (dry_run or plan) else None
+        self.archive = None
+        self.archive_root = root
+        self.dry_run = dry_run or plan is not None or archive_only
         self.move = move
-        self.writepath = {}
-        self.ignore = defaultdict(bool)
-        self.mov_keys = {}
-        self.img_keys = {}
+        self.writepath = SpillMap(self.spill)
+        self.ignore = SpillMap(self.spill)
         self.verbose = verbose
-        raw_ext = '(3fr|ari|arw|bay|crw|cr2|cap|dcs|dcr|'\
-                  'dng|drf|eip|erf|fff|iiq|k25|kdc|mdc|mef|'\
-                  'mos|mrw|nef|nrw|obm|orf|pef|ptx|pxn|r3d|'\
-                  'raf|raw|rwl|rw2|rwz|sr2|srf|srw|x3f)'
-        mov_ext = '(mov|mp4)'
-        self.pattern_raw = re.compile(r'\.{0}$'.format(raw_ext), re.IGNORECASE)
-        self.pattern_jpg = re.compile(r'\.jpe{0,1}g$', re.IGNORECASE)
-        self.pattern_mov = re.compile(r'\.{0}$'.format(mov_ext), re.IGNORECASE)
-
         self.set_gps(gps_option)
         self.match = match
-
-    # checks if a directory exists, if not it creates it
-    def ensure_dir(self, f):
-        d = os.path.dirname(f)
-        if not os.path.exists(d):
-            os.makedirs(d)
-            print(f"Created path: {d}")
+        self.jobs = max(1, jobs)
+        self.copy_jobs = max(1, copy_jobs)
+        self.device_jobs = max(1, device_jobs)
+        self.exif_reader = exif_reader
+        self.geocoder = geocoder
+        self.resume = resume
+        self.journal = None
+        self.dedup = dedup
+        self.verify = verify
+        self.reorder = reorder
+        self.profile_path = profile
+        self.profiler = Profiler(enabled=profile is not None)
+        self.library = None
+        # destination -> source of the files handed to the copy engine
+        self.claimed = {}
+        if self.use_gps and geocoder == 'offline' and \
+           self.gazetteer_path is None:
+            raise RuntimeError(
+                "[Error] Offline geocoding needs a Gazetteer in the config!")
+        self.copier = None
+        self.use_cache = use_cache
+        self.events = None
+        self.metadata_cache = None
+        self.geocode_cache = None
+        if use_cache and self.use_gps and geocoder == 'nominatim':
+            self.geocode_cache = GeocodeCache(
+                os.path.join(self.cache_dir, 'geocode.sqlite'),
+                grid=self.geocode_grid,
+                ttl=self.geocode_ttl * 24 * 3600,
+                max_entries=self.geocode_cache_size)
+        if use_cache:
+            context = f"{self.camera_maker}\0{self.camera_model}"
+            if any(camera_rules.values()):
+                rules = json.dumps(camera_rules, sort_keys=True)
+                context += '\0' + hashlib.sha1(
+                    rules.encode('utf-8')).hexdigest()
+            self.metadata_cache = MetadataCache(
+                os.path.join(self.cache_dir, 'metadata.sqlite'),
+                context,
+                max_entries=metadata_cache_size,
+                rebuild=rebuild_cache)
 
     def set_gps(self, gps_option):
         if gps_option is not None:
@@ -340,32 +2635,49 @@ class PicMover:
         else:
             self.use_gps = False
 
-    # Returns an xml tree of the search
-    def gps_query(self, coords):
-        html = urlopen(
-            "http://nominatim.openstreetmap.org/reverse?"
-            f"format=xml&lat={coords[0]}&lon={coords[1]}")
-        return ET.fromstring(html.read())
-
-    def get_gps_name(self, exif, metadata):
-        coordinates = exif.gps(metadata)
+    # Start looking up the location of META in the background, so
+    # it's known by the time add_path needs it.
+    def prefetch_address(self, meta):
+        if self.use_gps and meta.gps and self.geocoder == 'nominatim':
+            self.geocoder_stage().prefetch(meta.gps)
+
+    def geocoder_stage(self):
+        if self.geocode_stage is None:
+            self.geocode_stage = GeocodeStage(
+                self.geocode_url,
+                self.geocode_cache,
+                grid=self.geocode_grid,
+                workers=self.geocode_workers,
+                rate=self.geocode_rate)
+        return self.geocode_stage
+
+    # Returns the Address of the coordinates, from the gazetteer if
+    # geocoding offline. Otherwise from Nominatim, or the geocode
+    # cache if a nearby location has been looked up before.
+    def reverse_geocode(self, coords):
+        if self.geocoder == 'offline':
+            if self.gazetteer is None:
+                self.gazetteer = Gazetteer(
+                    self.gazetteer_path,
+                    os.path.join(self.cache_dir, 'gazetteer.idx'))
+            return self.gazetteer.lookup(coords)
+        return self.geocoder_stage().get(coords)
+
+    def get_gps_name(self, coordinates):
         name = ''
         if len(coordinates):
-            xml = self.gps_query(coordinates)
-            if xml is not None:
-
-                if self.verbose:
-                    print(f"Address from GPS: {xml[0].text}")
-                if len(xml) == 1:
-                    print(f"[Error] {xml[0]}")
-                    return 'Unknown location'
-                for opt in self.gps_option:
-                    if opt == 'full':
-                        name = xml[0].text
-                        break
-                    elm = xml[1].find(opt)
-                    if elm is not None:
-                        name += f", {elm.text}"
+            address = self.reverse_geocode(coordinates)
+            if self.verbose:
+                print(f"Address from GPS: {address.display}")
+            if address.error is not None:
+                print(f"[Error] {address.error}")
+                return 'Unknown location'
+            for opt in self.gps_option:
+                if opt == 'full':
+                    name = f", {address.display}"
+                    break
+                if address.parts.get(opt) is not None:
+                    name += f", {address.parts[opt]}"
 
         return name[2:]
 
@@ -376,53 +2688,152 @@ class PicMover:
         filename = filename[start:]
         return filename
 
-    # First check if the path exists, if true; move the file
-    # Only if the file doesn't exists at that location
-    def move_file(self, filename, writepath):
-
-        # Then move it to the new location
-        # if that succeeded remove the image from the image pool
-        filepath = os.path.join(self.IMAGE_POOL_PATH, filename)
-        writepath = writepath + filename
+    # Skip files already in the library and give the file a unique
+    # name if another file is using its name. Returns the path to write
+    # the file to or None if it's a duplicate.
+    def deduplicate(self, filepath, writepath, st):
+        if self.library is None:
+            print("Indexing the library")
+            self.library = LibraryIndex(
+                os.path.join(self.cache_dir, 'library.sqlite'),
+                [self.TARGET_IMAGE_PATH, self.TARGET_VIDEO_PATH])
+        duplicate, digest = self.library.find(filepath, st.st_size)
+        if duplicate is not None:
+            print(f" -Already imported as {duplicate}")
+            return None
+
+        stem, ext = os.path.splitext(writepath)
+        count = 1
+        while os.path.exists(writepath) or self.library.contains(writepath):
+            writepath = f"{stem}_{count}{ext}"
+            count += 1
+        if count > 1:
+            print(f" -Name is taken by another file, using {writepath}")
+        self.library.add(writepath, st.st_size, st.st_mtime_ns, digest,
+                         filepath)
+        return writepath
+
+    # Give the file a unique name if another file with different
+    # content is using its name, one at the destination or one already
+    # handed to the copy engine in this import. Two cameras of the
+    # same model, or a camera whose file counter wrapped, use the same
+    # names. Returns the path to write the file to or None if it's
+    # already there.
+    def claim_name(self, filepath, writepath, st):
+        stem, ext = os.path.splitext(writepath)
+        count = 1
+        candidate = writepath
+        while True:
+            # The source of a file being moved is gone once it's there.
+            others = [self.claimed[candidate], candidate] \
+                if candidate in self.claimed else [candidate]
+            if not any(map(os.path.exists, others)):
+                break
+            if same_content(filepath, st, others):
+                print(f" -Already imported as {candidate}")
+                return None
+            candidate = f"{stem}_{count}{ext}"
+            count += 1
+        if count > 1:
+            print(f" -Name is taken by another file, using {candidate}")
+        self.claimed[candidate] = filepath
+        return candidate
+
+    # Hand the file over to the copy engine, it will only be copied
+    # (or moved) if the file doesn't exists at that location. Returns
+    # where the file is written or None if it's skipped.
+    def move_file(self, entry, writepath):
+        filepath = entry.path
+        writepath = writepath + entry.name
+        if self.dedup:
+            with self.profiler.stage('dedup'):
+                writepath = self.deduplicate(filepath, writepath,
+                                             entry.stat)
+        else:
+            writepath = self.claim_name(filepath, writepath, entry.stat)
+        if writepath is None:
+            if self.journal is not None:
+                self.journal.finished(filepath)
+            return None
         if not self.dry_run:
-            # check to see if the directory exists, if not create it
-            self.ensure_dir(writepath)
-
-            if not os.path.exists(writepath):
-                shutil.copy2(filepath, writepath)
-                if self.verbose:
-                    print(" -Moved to", writepath)
-                if self.move:
-                    os.remove(filepath)
+            self.copier.submit(filepath, writepath, self.move,
+                               entry.stat.st_dev)
+        elif self.archive is not None:
+            # Only writing the archive, straight from the source.
+            self.archive.add(filepath, writepath)
         else:
             if self.verbose:
                 print(" -Moved to", writepath)
+        return writepath
+
+    # Index of the events at the destination, scanned the first time
+    # it's needed.
+    def event_index(self):
+        if self.events is None:
+            cache_path = None
+            if self.use_cache:
+                cache_path = os.path.join(self.cache_dir, 'events.json')
+            with self.profiler.stage('event_scan'):
+                self.events = EventIndex(
+                    [self.TARGET_IMAGE_PATH, self.TARGET_VIDEO_PATH],
+                    cache_path)
+        return self.events
+
+    # Prompt the user, or print the prompt and use DEFAULT when making
+    # a plan.
+    def ask(self, prompt, default):
+        if self.interactive:
+            with self.profiler.stage('prompt'):
+                return input(prompt)
+        print(f"{prompt}{default}")
+        return default
+
+    # Returns the (answer, name) of the first rule matching the date
+    # of DATA, or None.
+    def find_rule(self, data):
+        for pattern, answer, name in self.rules:
+            if fnmatch.fnmatchcase(data.date, pattern):
+                return answer, name
+        return None
 
     def print_match(self, matches, idx):
         print(f"Found events using match {idx}: {matches[idx]}")
 
-    def add_path(self, metadata, exif, data):
+    def add_path(self, data):
         path = os.path.join(data.make, data.model, data.date[0:4])
         path_to_events = os.path.join(data.target_path, path)
 
-        matches = glob.glob(os.path.join(path_to_events, f'{data.date}*'))
+        events = self.event_index()
+        with self.profiler.stage('event_lookup'):
+            matches = events.find(path_to_events, data.date)
         print(f"path: {path}")
         print(f"path to events: {path_to_events}")
         print(data.make, data.model)
         # Found potential matching events
         answer = 'n'
         num_matches = len(matches)
+        rule = self.find_rule(data)
         while(True):
-            if num_matches:
+            if rule is not None:
+                answer = rule[0]
+                if answer.isdigit():
+                    if num_matches:
+                        idx = min(int(answer), num_matches-1)
+                        self.print_match(matches, idx)
+                        answer = str(idx)
+                    else:
+                        answer = 'n'
+            elif num_matches:
                 if not self.ignore_all:
                     if self.match is None:
                         print("Found events matching the date. "
                               "Use one of these instead?")
                         for i, m in enumerate(matches):
-                            print(f"- [{i}] add to: {self.strip_path(path_to_events, m, 0)}")
-                        answer = input("- [n] to create a new.\n"
-                                       "- [i] to ignore this event.\n"
-                                       "- Type one of the options above: ")
+                            print(f"- [{i}] add to: {m}")
+                        answer = self.ask("- [n] to create a new.\n"
+                                          "- [i] to ignore this event.\n"
+                                          "- Type one of the options "
+                                          "above: ", 'n')
                     elif self.match[0] < num_matches:
                         self.print_match(matches, self.match[0])
                         answer = str(self.match[0])
@@ -433,8 +2844,9 @@ class PicMover:
                         answer = str(idx)
                 else:
                     answer = 'i'
-            if self.use_gps:
-                name = self.get_gps_name(exif, metadata)
+            if self.use_gps and rule is None:
+                with self.profiler.stage('gps_query'):
+                    name = self.get_gps_name(data.gps)
 
                 # Empty string means that it didn't have any valid gps info
                 if len(name):
@@ -442,20 +2854,19 @@ class PicMover:
                     break
 
             if answer.isdigit() and int(answer) < len(matches):
-                event = self.strip_path(
-                    path_to_events,
-                    matches[int(answer)],
-                    0
-                )
-                self.writepath[data.key] = os.join.path(path, event)
+                event = matches[int(answer)]
+                self.writepath[data.key] = os.path.join(path, event)
                 break
             elif answer == "n":
                 name = ''
+                if rule is not None:
+                    name = rule[1] or ''
                 # Ask for input if date_only isn't set or if it founds
                 # some matches.
-                if not self.date_only or num_matches:
+                elif not self.date_only or num_matches:
                     # Ask for name
-                    name = input(f'[{data.filetype}] Name of event ( {data.date} <name> ): ')
+                    name = self.ask(f'[{data.filetype}] Name of event '
+                                    f'( {data.date} <name> ): ', '')
 
                 if len(name):
                     path = os.path.join(path, f'{data.date} {name}')
@@ -466,24 +2877,14 @@ class PicMover:
                 self.writepath[data.key] = path
                 break
             elif answer == 'i':
-                self.ignore[data.key] = True
+                self.ignore.add(data.key)
                 break
             else:
                 print('Unknown option, try again.')
 
-    def add_file(self, filename, exif, filetype, target_path):
+    def add_file(self, filename, meta, filetype, target_path):
         # go to the correct folder e.g. ~/Nikon/D7000/2011/
-        # Get the metadata from the image
-        path = os.path.join(self.IMAGE_POOL_PATH, filename)
-        metadata = GExiv2.Metadata(path)
-        if not metadata:
-            raise ValueError(f"Unable to open metadata for '{path}'")
-        # Extract usfull information from the metadata object
-
-        make = exif.make(metadata)
-        model = exif.model(metadata)
-        date = exif.date(metadata, filename)
-
+        date = meta.date or fallback_date(filename)
         # GExiv2 format the date with : instead of -.
         date = date.replace(":", "-")
         misc = ""
@@ -491,115 +2892,441 @@ class PicMover:
         if self.use_gps:
             # If using the gps add the gps coordinates to the key to
             # avoid clumping pictures taken at different locations.
-            gps = exif.gps(metadata)
-            if gps:
-                misc = f"{gps[0]}{gps[1]}"
+            if meta.gps:
+                misc = f"{meta.gps[0]}{meta.gps[1]}"
 
-        # Create key to filename to avoid parsing metadata twice
-        key = f"{make}{model}{date}{misc}"
-        self.img_keys[filename] = key
+        # Files with the same key end up in the same event
+        key = f"{meta.make}{meta.model}{date}{misc}"
 
         if (key not in self.writepath) and (key not in self.ignore):
-            data = FileData(key, date, make, model, filetype, target_path)
-            self.add_path(metadata, exif, data)
-
-    def process_file(self, filename, subdir, target_path):
-
-        key = self.img_keys[filename]
-        if self.ignore[key]:
+            data = FileData(key, date, meta.make, meta.model, meta.gps,
+                            filetype, target_path)
+            self.add_path(data)
+            if self.journal is not None:
+                if key in self.writepath:
+                    self.journal.event(key, self.writepath[key])
+                else:
+                    self.journal.ignored(key)
+        return key
+
+    # Imports from the same pool to the same destination, or of the
+    # same PLAN, share the journal.
+    def journal_path(self, plan=None):
+        if plan is not None:
+            session = os.path.abspath(plan)
+        else:
+            paths = [os.path.abspath(p) for p in self.IMAGE_POOL_PATHS]
+            paths += [self.TARGET_IMAGE_PATH, self.TARGET_VIDEO_PATH]
+            session = '\0'.join(paths)
+        name = hashlib.sha1(session.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, 'journals', f'{name}.jsonl')
+
+    # Start writing the archive the first time files are imported,
+    # watch adds each batch to the same archive.
+    def open_archive(self):
+        if self.archive_path is not None and self.archive is None:
+            self.archive = ArchiveWriter(self.archive_path,
+                                         self.archive_root)
+
+    # Open the journal for this import, when resuming restore the
+    # decisions made and finish removing the sources of files that
+    # were copied but not removed.
+    def open_journal(self, plan=None):
+        path = self.journal_path(plan)
+        if self.resume and not os.path.exists(path):
+            print("No interrupted import to resume, starting from scratch.")
+        self.journal = ImportJournal(path, self.resume, self.spill)
+        self.writepath.update(self.journal.writepath.items())
+        self.ignore.update(self.journal.ignore.items())
+        if self.journal.done:
+            print(f"Resuming, {len(self.journal.done)} files are "
+                  "already imported.")
+
+        for src, dst in list(self.journal.copied.items()):
+            if self.move and os.path.exists(src) and \
+               os.path.exists(dst) and \
+               os.path.getsize(src) == os.path.getsize(dst):
+                os.remove(src)
+            self.journal.finished(src)
+            self.journal.done.add(src)
+
+    # Extract the metadata for each group of PoolFiles in GROUPS from
+    # the first file in the group, yields (group, metadata) in the
+    # same order as GROUPS
+    # so the prompting stays deterministic. Files found in the metadata
+    # cache are not opened, the rest are read using a pool of worker
+    # processes if jobs > 1. At most queue_size files are in flight,
+    # so the workers only run that far ahead of the consumer.
+    def extract_metadata(self, groups):
+        cache = self.metadata_cache
+        pool = None
+        if self.jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(
+                max_workers=self.jobs,
+                initializer=init_worker,
+                initargs=(self.camera_maker, self.camera_model,
+                          self.exif_reader, self.filters))
+        else:
+            init_worker(self.camera_maker, self.camera_model,
+                        self.exif_reader, self.filters)
+        queue_size = self.jobs * 16
+        pending = deque()
+        try:
+            for group in groups:
+                entry = group[0]
+                job = (entry.path, self.filetypes[entry.filetype][0])
+                ident = meta = None
+                if cache is not None:
+                    ident = cache.identity(entry.path, entry.stat)
+                    meta = cache.get(ident)
+                if meta is None and pool is not None:
+                    meta = pool.submit(extract_worker, job)
+                elif meta is None:
+                    with self.profiler.stage('extract'):
+                        meta = extract_worker(job)
+                    if ident is not None:
+                        cache.put(ident, meta)
+                if isinstance(meta, FileMeta):
+                    self.prefetch_address(meta)
+                pending.append([group, ident, meta])
+                while len(pending) > queue_size:
+                    yield self.resolve(pending.popleft())
+                for job in pending:
+                    if isinstance(job[2], Future) and job[2].done():
+                        self.resolve(job)
+            while pending:
+                yield self.resolve(pending.popleft())
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+    # Wait for the metadata of ENTRY if it's still being extracted,
+    # store it in the cache and start looking up its location.
+    def resolve(self, job):
+        group, ident, meta = job
+        if isinstance(meta, Future):
+            with self.profiler.stage('extract_wait'):
+                meta = job[2] = meta.result()
+            if ident is not None:
+                self.metadata_cache.put(ident, meta)
+            self.prefetch_address(meta)
+        return group, meta
+
+    # Drop the files in DONE, they are already imported.
+    def skip_done(self, groups, done):
+        for group in groups:
+            group = [entry for entry in group if entry.path not in done]
+            if not group:
+                continue
+            if os.path.splitext(group[0].name)[1].lower() in SIDECARS:
+                # Nothing left to read the metadata from.
+                for entry in group:
+                    print(f"[Warning] Skipping {entry.path}, the file it "
+                          "belongs to is already imported")
+                continue
+            yield group
+
+    def process_file(self, entry, key, subdir, target_path):
+        # The plan has absolute paths so it can be applied from any
+        # directory.
+        if key in self.ignore:
+            if self.plan is not None:
+                self.plan.add(PlanEntry(os.path.abspath(entry.path), key,
+                                        '', 'ignore'))
             return
 
-        path = os.path.join(target_path, self.writepath[key], subdir)
+        event_path = os.path.join(target_path, self.writepath[key])
+        path = os.path.join(event_path, subdir)
         # Move file to the new path
-        self.move_file(filename, path)
-
-    def print_process(self, type_name, filename, count, total):
-        print(f"Processing {type_name} : {filename} [{count}/{total}]")
+        with self.profiler.stage('move_file'):
+            writepath = self.move_file(entry, path)
+        if self.plan is not None:
+            action = 'move' if self.move else 'copy'
+            self.plan.add(PlanEntry(
+                os.path.abspath(entry.path), key,
+                os.path.abspath(writepath) if writepath else '',
+                action if writepath else 'skip'))
+        if not self.dry_run and self.events is not None:
+            self.events.add(event_path)
+
+    def print_process(self, type_name, filename, count):
+        print(f"Processing {type_name} : {filename} [{count}]")
 
     # moves the file based on metadata (user comment and date)
     def exe(self):
-        if HAS_NOTIFY_SUPPORT:
-            Notify.init("picmover")
-            notify = Notify.Notification.new(
-                "picmover", f"Copying files from {self.IMAGE_POOL_PATH}"
-            )
-            notify.show()
-
         # Scan for paths
         if self.verbose:
             print("[------------- Scaning for files ---------------]")
 
-        filenames_raw = []
-        filenames_jpg = []
-        filenames_mov = []
-        for f in os.listdir(self.IMAGE_POOL_PATH):
-            if re.search(self.pattern_raw, f):
-                filenames_raw.append(f)
-            elif re.search(self.pattern_jpg, f):
-                filenames_jpg.append(f)
-            elif re.search(self.pattern_mov, f):
-                filenames_mov.append(f)
-        total = len(filenames_raw) + len(filenames_jpg) + len(filenames_mov)
-
-        if total == 0:
-            print("No files found, exit program.")
-            return
-
-        if self.verbose:
-            print("[-------------- Preping files ------------------]")
-        exif_img = ExifImg(self.camera_maker, self.camera_model)
-        exif_mov = ExifMov(self.camera_maker, self.camera_model)
+        # The pool is scanned while the metadata is extracted in the
+        # background and the files are copied, a file is handed over
+        # to the copy engine as soon as its event is known.
+        self.import_files(
+            self.profiler.timed('scan', scan_pools(self.IMAGE_POOL_PATHS)))
+        self.close()
 
-        for filename in filenames_raw:
-            self.add_file(filename, exif_img, 'RAW', self.TARGET_IMAGE_PATH)
+    def pool_names(self):
+        return ', '.join(self.IMAGE_POOL_PATHS)
 
-        for filename in filenames_jpg:
-            self.add_file(filename, exif_img, 'JPG', self.TARGET_IMAGE_PATH)
-
-        for filename in filenames_mov:
-            self.add_file(filename, exif_mov, 'MOV', self.TARGET_VIDEO_PATH)
+    # Show MESSAGE as a desktop notification, if Notify is installed.
+    def notify(self, message):
+        Notify = notifications()
+        if Notify is not None:
+            Notify.Notification.new("picmover", message).show()
 
+    # Import the shots in GROUPS, returns the number of files.
+    def import_files(self, groups):
         if self.verbose:
-            print("[--------------- Moving files ------------------]")
-
-        count = 1
-
-        for filename in filenames_raw:
-            type_name = "raw image"
-            self.print_process(type_name, filename, count, total)
-            self.process_file(
-                filename,
-                self.subdir_raw,
-                self.TARGET_IMAGE_PATH
-            )
-            count += 1
-
-        for filename in filenames_jpg:
-            type_name = "jpg image"
-            self.print_process(type_name, filename, count, total)
-            self.process_file(
-                filename,
-                self.subdir_jpg,
-                self.TARGET_IMAGE_PATH
-            )
-            count += 1
+            print("[------------ Preping and moving files ---------]")
 
-        for filename in filenames_mov:
-            type_name = "movie"
-            self.print_process(type_name, filename, count, total)
-            self.process_file(
-                filename,
-                self.subdir_mov,
-                self.TARGET_VIDEO_PATH
-            )
-            count += 1
+        self.claimed = {}
+        if self.plan_path is not None:
+            self.plan = PlanWriter(self.plan_path, self.IMAGE_POOL_PATHS)
+        self.open_archive()
+        if not self.dry_run:
+            self.open_journal()
+            self.copier = CopyEngine(self.copy_jobs, verbose=self.verbose,
+                                     journal=self.journal,
+                                     verify=self.verify,
+                                     device_jobs=self.device_jobs,
+                                     reorder=256 if self.reorder else 0,
+                                     profiler=self.profiler,
+                                     archive=self.archive)
+
+        if self.journal is not None and self.journal.done:
+            groups = self.skip_done(groups, self.journal.done)
+
+        # The files in a group are the same shot, so they share the
+        # metadata and the event but go to their own subdir.
+        count = 0
+        for group, meta in self.extract_metadata(groups):
+            # Only bother with notifications, and loading Notify, once
+            # there is something to copy.
+            if count == 0:
+                self.notify(f"Copying files from {self.pool_names()}")
+            first = group[0]
+            with self.profiler.stage('add_file'):
+                key = self.add_file(first.name, meta, first.filetype,
+                                    self.filetypes[first.filetype][1])
+            for entry in group:
+                _, target_path, subdir, type_name = \
+                    self.filetypes[entry.filetype]
+                count += 1
+                self.print_process(type_name, entry.name, count)
+                self.process_file(entry, key, subdir, target_path)
+
+        if count == 0:
+            print("No files found.")
+
+        if self.plan is not None:
+            self.plan.close()
+            print(f"Wrote the plan for {self.plan.count} files to "
+                  f"{self.plan_path}")
+
+        if self.copier is not None:
+            self.copier.finish()
+            print(self.copier.summary())
+        if self.journal is not None:
+            self.journal.close(complete=True)
+            self.journal = None
+        if self.events is not None:
+            self.events.save()
+        if self.metadata_cache is not None:
+            self.metadata_cache.commit()
+        if count:
+            self.notify(
+                f"Done copying {count} files from {self.pool_names()}")
+        return count
+
+    # Close the caches and print how well they did.
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+            print(self.archive.summary())
+        if self.library is not None:
+            self.library.close(commit=not self.dry_run)
+        if self.metadata_cache is not None:
+            self.metadata_cache.close()
+            print(self.metadata_cache.summary())
+        if self.geocode_stage is not None:
+            self.geocode_stage.close()
+        if self.geocode_cache is not None:
+            self.geocode_cache.close()
+            print(self.geocode_cache.summary())
+        self.writepath.close()
+        self.ignore.close()
+        if self.profile_path is not None:
+            print(self.profiler.summary())
+            with open(self.profile_path, 'w') as f:
+                json.dump(self.profiler.report(), f, indent=2)
+                f.write('\n')
         print("done")
-        if HAS_NOTIFY_SUPPORT:
-            notify = Notify.Notification.new(
-                "picmover",
-                f"Done copying files from {self.IMAGE_POOL_PATH}"
-            )
-            notify.show()
+
+    # Wait for the pools (and the destination) to be mounted and
+    # import the files as they show up, until interrupted. Everything
+    # found when a pool appears is imported, after that only new
+    # files. A batch is imported once no new files have shown up for
+    # SETTLE seconds. A file is only imported once it's closed after
+    # being written, or for files already there, once it hasn't been
+    # modified for SETTLE seconds. The caches and the answers for the
+    # events are kept between the batches.
+    def watch(self, settle=2.0):
+        inotify = Inotify()
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        # Changes to the mount table show up as POLLPRI on mountinfo.
+        mountinfo = open('/proc/self/mountinfo')
+        poller = select.poll()
+        poller.register(inotify.fd, select.POLLIN)
+        poller.register(mountinfo, select.POLLPRI)
+        watches = {}
+        # dir -> scan recursively
+        dirty = {}
+        imported = SpillMap(self.spill)
+        ready = set()
+        # Files created and not closed yet, and files closed since.
+        writing = set()
+        written = set()
+
+        def watch_tree(path):
+            for root, dirs, _ in os.walk(path):
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
+                try:
+                    watches[inotify.add_watch(root, mask)] = root
+                except OSError as e:
+                    print(f"[Warning] Couldn't watch {root}: {e.strerror}")
+
+        def is_complete(entry, now):
+            if entry.path in written:
+                return True
+            return entry.path not in writing and \
+                now - entry.stat.st_mtime >= settle
+
+        # A pool is available once it and the mounts it needs (the
+        # Root, not the other pools) are mounted.
+        def available(pool):
+            return os.path.isdir(pool) and \
+                all(os.path.ismount(m) for m in self.mounts
+                    if m == pool or m not in self.IMAGE_POOL_PATHS)
+
+        print(f"Watching {self.pool_names()}")
+        try:
+            while True:
+                for pool in self.IMAGE_POOL_PATHS:
+                    if available(pool) and pool not in ready:
+                        print(f"{pool} is available")
+                        watch_tree(pool)
+                        dirty[pool] = True
+                        ready.add(pool)
+                    elif pool in ready and not available(pool):
+                        print(f"{pool} is gone")
+                        # The watches are dropped by the kernel, a card
+                        # inserted again is imported from scratch.
+                        prefix = os.path.join(pool, '')
+                        for d in list(dirty):
+                            if d == pool or d.startswith(prefix):
+                                del dirty[d]
+                        imported.discard_prefix(prefix)
+                        for files in (writing, written):
+                            files.difference_update(
+                                [f for f in files if f.startswith(prefix)])
+                        ready.discard(pool)
+
+                events = poller.poll(settle * 1000 if dirty else None)
+                for fd, _ in events:
+                    if fd != inotify.fd:
+                        mountinfo.seek(0)
+                        mountinfo.read()
+                        continue
+                    for wd, flags, name in inotify.read():
+                        if flags & IN_IGNORED:
+                            watches.pop(wd, None)
+                            continue
+                        if wd not in watches or name.startswith('.'):
+                            continue
+                        path = os.path.join(watches[wd], name)
+                        if flags & IN_ISDIR:
+                            watch_tree(path)
+                            dirty[path] = True
+                        elif flags & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                            writing.discard(path)
+                            written.add(path)
+                            dirty.setdefault(watches[wd], False)
+                        elif flags & IN_CREATE:
+                            writing.add(path)
+
+                if events or not dirty or not ready:
+                    continue
+                groups = self.profiler.timed(
+                    'scan', (group for d, recursive in list(dirty.items())
+                             for group in scan_pool(d, recursive)))
+                dirty.clear()
+                now = time.time()
+                batch = []
+                for group in self.skip_done(groups, imported):
+                    if not all(is_complete(e, now) for e in group):
+                        # A file still open is looked at again when
+                        # it's closed, the others after a while.
+                        if not any(e.path in writing for e in group):
+                            dirty.setdefault(
+                                os.path.dirname(group[0].path), False)
+                        continue
+                    batch.append(group)
+                    for entry in group:
+                        imported.add(entry.path)
+                        written.discard(entry.path)
+                if batch:
+                    self.import_files(batch)
+                    self.resume = False
+        except KeyboardInterrupt:
+            print("Stopped watching")
+        finally:
+            inotify.close()
+            mountinfo.close()
+            imported.close()
+            self.close()
+
+    # Copy the files in the plan written by plan mode, without
+    # extracting any metadata or prompting.
+    def apply(self, plan_path):
+        entries = read_plan(plan_path)
+        self.notify(f"Copying files from plan {plan_path}")
+
+        self.open_archive()
+        if not self.dry_run:
+            self.move = any(entry.action == 'move' for entry in entries)
+            self.open_journal(plan_path)
+            self.copier = CopyEngine(self.copy_jobs, verbose=self.verbose,
+                                     journal=self.journal,
+                                     verify=self.verify,
+                                     device_jobs=self.device_jobs,
+                                     reorder=256 if self.reorder else 0,
+                                     profiler=self.profiler,
+                                     archive=self.archive)
+        for entry in entries:
+            if entry.action not in ('copy', 'move'):
+                continue
+            if self.journal is not None and entry.src in self.journal.done:
+                continue
+            if self.dry_run and self.archive is not None:
+                self.archive.add(entry.src, entry.dst)
+            elif self.dry_run:
+                print(f"{entry.src} -> {entry.dst}")
+            else:
+                try:
+                    device = os.stat(entry.src).st_dev
+                except OSError:
+                    device = None
+                self.copier.submit(entry.src, entry.dst,
+                                   entry.action == 'move', device)
+
+        if self.copier is not None:
+            self.copier.finish()
+            print(self.copier.summary())
+        if self.journal is not None:
+            self.journal.close(complete=True)
+        self.close()
+        self.notify(f"Done copying files from plan {plan_path}")
 
 
 # Based on Guido van Rossu's main function
@@ -620,12 +3347,31 @@ def main(argv=None):
     parser = argparse\
         .ArgumentParser(description="picmover: Simple program that "
                         "moves images according to metadata")
+    parser.add_argument(
+        "command",
+        nargs='?',
+        choices=['import', 'plan', 'apply', 'watch'],
+        default='import',
+        help="import (default) imports the files, plan writes what an "
+        "import would do to PLAN without prompting, apply imports the "
+        "files in PLAN and watch imports the files as they show up in "
+        "the pool."
+    )
+    parser.add_argument(
+        "plan_file",
+        nargs='?',
+        metavar='PLAN',
+        default='plan.json',
+        help="Plan to write or apply, written as TSV if it ends with "
+        ".tsv otherwise as JSON. Defaults to plan.json."
+    )
     parser.add_argument(
         "-p", "--pool",
-        default=os.getcwd(),
+        action='append',
         dest='pool',
         help="Source path it will look for files, "
-        "defaults to the directory it's called from."
+        "defaults to the directory it's called from. Can be given "
+        "more than once to import from several pools at the same time."
     )
     parser.add_argument(
         "-v",
@@ -709,9 +3455,141 @@ def main(argv=None):
         "instead of prompting user. If MATCH is greater than "
         "number of matches it will pick the last one."
     )
+    parser.add_argument(
+        "-j", "--jobs",
+        dest='jobs',
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of processes to use when extracting the "
+        "metadata, defaults to the number of CPUs."
+    )
+    parser.add_argument(
+        "--copy-jobs",
+        dest='copy_jobs',
+        type=int,
+        default=4,
+        help="Number of files to copy at the same time, defaults to 4."
+    )
+    parser.add_argument(
+        "--device-jobs",
+        dest='device_jobs',
+        type=int,
+        default=1,
+        help="Number of files to copy at the same time from each device "
+        "the pools are on, defaults to 1 so each card is read "
+        "sequentially."
+    )
+    parser.add_argument(
+        "--exif-reader",
+        dest='exif_reader',
+        choices=['gexiv2', 'fast'],
+        default='gexiv2',
+        help="How to read the metadata. 'fast' only parses the EXIF "
+        "header of JPEG and TIFF based raw files and the metadata "
+        "atoms of QuickTime/MP4 files, and uses gexiv2 for the rest. "
+        "Defaults to gexiv2."
+    )
+    parser.add_argument(
+        "--geocoder",
+        dest='geocoder',
+        choices=['nominatim', 'offline'],
+        default='nominatim',
+        help="Where to look up the location names for --gps. "
+        "'offline' uses the Gazetteer set in the config file, it only "
+        "knows city, state, country and country_code. "
+        "Defaults to nominatim."
+    )
+    parser.add_argument(
+        "--rules",
+        dest='rules',
+        help="File with rules that answer the prompts for the events, "
+        "see picmover(1)."
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        default=False,
+        dest='verify',
+        help="Read back each copied file from the disk and compare it "
+        "with the source before removing the source when moving."
+    )
+    parser.add_argument(
+        "--no-reorder",
+        action="store_false",
+        default=True,
+        dest='reorder',
+        help="Copy the files in the order they are found instead of "
+        "one destination directory at a time in the order they are "
+        "stored on the disk."
+    )
+    parser.add_argument(
+        "--archive",
+        metavar="PATH",
+        help="Also write the imported files to the archive PATH, with "
+        "the same layout as the destination. A .zip, .tar.zst or "
+        "otherwise a tar, written in one pass without reading the "
+        "sources again."
+    )
+    parser.add_argument(
+        "--archive-only",
+        action="store_true",
+        default=False,
+        dest='archive_only',
+        help="Only write the archive given by --archive, nothing is "
+        "copied to the destination."
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        default=False,
+        dest='dedup',
+        help="Skip files whose content already is in the destination "
+        "library, even if the name differs. Files whose name is taken "
+        "by a different file are given a unique name instead of being "
+        "skipped."
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        dest='resume',
+        help="Resume an interrupted import from the same pool, "
+        "files already imported are skipped and the events picked "
+        "are reused without prompting."
+    )
+    parser.add_argument(
+        "--profile",
+        dest='profile',
+        metavar='PATH',
+        help="Print how long each stage of the import took and write "
+        "it as JSON to PATH."
+    )
+    parser.add_argument(
+        "--cprofile",
+        dest='cprofile',
+        metavar='PATH',
+        help="Run the import under cProfile and write the stats to PATH, "
+        "see the pstats module. Only covers the main thread."
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_false",
+        default=True,
+        dest='use_cache',
+        help="Don't use the metadata cache, "
+        "parse the metadata of every file."
+    )
+    parser.add_argument(
+        "--rebuild-cache",
+        action="store_true",
+        default=False,
+        dest='rebuild_cache',
+        help="Throw away the metadata cache and rebuild it "
+        "from the files in the pool."
+    )
     result = parser.parse_args()
     pm = PicMover(result.path,
-                  result.pool,
+                  result.pool or [os.getcwd()],
                   result.gps,
                   verbose=result.verbose,
                   dry_run=result.dry_run,
@@ -720,8 +3598,40 @@ def main(argv=None):
                   ignore_all=result.ignore_all,
                   match=result.match,
                   camera_model=result.model[0],
-                  camera_maker=result.maker[0])
-    pm.exe()
+                  camera_maker=result.maker[0],
+                  jobs=result.jobs,
+                  copy_jobs=result.copy_jobs,
+                  device_jobs=result.device_jobs,
+                  exif_reader=result.exif_reader,
+                  geocoder=result.geocoder,
+                  resume=result.resume,
+                  dedup=result.dedup,
+                  verify=result.verify,
+                  plan=(result.plan_file if result.command == 'plan'
+                        else None),
+                  rules=result.rules,
+                  watch=result.command == 'watch',
+                  reorder=result.reorder,
+                  profile=result.profile,
+                  archive=result.archive,
+                  archive_only=result.archive_only,
+                  use_cache=result.use_cache,
+                  rebuild_cache=result.rebuild_cache)
+    profiler = None
+    if result.cprofile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if result.command == 'apply':
+            pm.apply(result.plan_file)
+        elif result.command == 'watch':
+            pm.watch()
+        else:
+            pm.exe()
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(result.cprofile)
     return 0
 
 